@@ -2,7 +2,7 @@ import styles from "./blueprint.module.css";
 import { useCallback, useEffect, useRef, useState } from "react";
 import { useNavigate, useOutletContext, useParams } from "react-router-dom";
 import { AddressOutletContextType } from "@/lib/types";
-import { ORIGIN_URL_PREFIX } from "@/lib/constants";
+import { imageUrl } from "@/lib/utils";
 import LocalDB from "@/lib/localdb";
 
 export default function Blueprint() {
@@ -101,7 +101,7 @@ export default function Blueprint() {
       } else {
         setImgStyle({
           backgroundImage: `linear-gradient(rgba(255, 255, 255, 0.5), rgba(255, 255, 255, 0.5)), url(${
-            ORIGIN_URL_PREFIX + blueprint.images["400"].href
+            imageUrl(blueprint.images["400"].href)
           })`,
           backgroundSize: "cover",
           minHeight: "400px",
@@ -116,7 +116,7 @@ export default function Blueprint() {
     <div className={styles.blueprintContainer} ref={containerRef}>
       {blueprint !== null && (
         <img
-          src={ORIGIN_URL_PREFIX + blueprint.images["2400"].href}
+          src={imageUrl(blueprint.images["2400"].href)}
           className={className}
           onClick={toggleZoom}
           alt={blueprint.description}
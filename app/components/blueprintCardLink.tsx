@@ -2,7 +2,7 @@ import { Link } from "react-router-dom";
 import Card from "react-bootstrap/Card";
 import { BlueprintInfo } from "@/lib/types";
 import styles from "./blueprintCardLink.module.css";
-import { ORIGIN_URL_PREFIX } from "@/lib/constants";
+import { imageUrl } from "@/lib/utils";
 
 export default function BlueprintCardLink({
   address,
@@ -16,7 +16,7 @@ export default function BlueprintCardLink({
       <Card className={`${styles.card} m-3`}>
         <Card.Img
           variant="top"
-          src={ORIGIN_URL_PREFIX + blueprint.images["400"].href}
+          src={imageUrl(blueprint.images["400"].href)}
           className={styles.cardImage}
         />
         <Card.Body>
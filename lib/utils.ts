@@ -1,5 +1,11 @@
+import { ORIGIN_URL_PREFIX } from "@/lib/constants";
+
 export const singularOrPlural = (
   i: number,
   singular: string,
   plural: string,
 ) => (i % 10 === 1 && i % 100 !== 11 ? singular : plural);
+
+// Mirrored previews have absolute URLs, the rest are paths on the archive
+export const imageUrl = (href: string) =>
+  href.startsWith("/") ? ORIGIN_URL_PREFIX + href : href;
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import os
+
+STATS_FILENAME = "address-stats.json"
+
+
+def content_stats(content: bytes, records: list[dict]) -> dict:
+    dates = [img_data["date"] for img_data in records if img_data.get("date")]
+    return {
+        "count": len(records),
+        "latest_date": max(dates) if dates else None,
+        "hash": hashlib.md5(content).hexdigest(),
+    }
+
+
+def file_stats(address_file: str) -> dict:
+    with open(address_file, "rb") as f:
+        content = f.read()
+    return content_stats(content, json.loads(content))
+
+
+def write_stats(scrape_dir: str, stats: dict) -> None:
+    stats_file = os.path.join(scrape_dir, STATS_FILENAME)
+    tmp_file = stats_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False)
+    os.replace(tmp_file, stats_file)
+
+
+def read_stats(scrape_dir: str) -> dict:
+    """
+    Map each address filename in `scrape_dir` to its record count, latest
+    date and md5 hash. Falls back to reading the address files when the
+    scrape was written without a stats file.
+    """
+    stats_file = os.path.join(scrape_dir, STATS_FILENAME)
+    if os.path.exists(stats_file):
+        with open(stats_file, encoding="utf-8") as f:
+            return json.load(f)
+
+    addresses_dir = os.path.join(scrape_dir, "addresses")
+    if not os.path.exists(addresses_dir):
+        return {}
+    return {
+        filename: file_stats(os.path.join(addresses_dir, filename))
+        for filename in os.listdir(addresses_dir)
+    }
@@ -0,0 +1,47 @@
+"""
+Encoding of the JSON artifacts served from the bucket.
+
+JSON is written without whitespace and without escaping Icelandic
+characters. The uploader compresses each file once, with the configured
+Content-Encoding, so the bucket and CDN serve it as is.
+"""
+
+import gzip
+import json
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/json; charset=utf-8"
+ENCODINGS = ("gzip", "br", "identity")
+
+
+def compact_dumps(obj) -> str:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def compact_dump(obj, f) -> None:
+    json.dump(obj, f, separators=(",", ":"), ensure_ascii=False)
+
+
+def choose_encoding(encoding: str) -> str:
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown content encoding {encoding}")
+    if encoding == "br" and brotli is None:
+        logger.warning("brotli is not installed, uploading gzip instead")
+        return "gzip"
+    return encoding
+
+
+def encode_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        # mtime=0 so the same content always compresses to the same bytes
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    if encoding == "br":
+        return brotli.compress(body, quality=11)
+    return body
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from http_client import (
+    CONNECT_TIMEOUT_SECONDS,
+    HEADERS,
+    POOL_MAXSIZE,
+    READ_TIMEOUT_SECONDS,
+    ClientStats,
+    Page,
+)
+from pacing import AdaptivePacer, is_retryable, parse_retry_after
+from response_cache import ResponseCache, content_hash
+
+logger = logging.getLogger(__name__)
+
+Response = namedtuple("Response", "status headers body")
+
+
+class AsyncHttpClient:
+    """
+    asyncio counterpart of `HttpClient`, on a pooled `aiohttp.ClientSession`.
+
+    Sends the same headers, conditional requests and retries, so the two
+    can be swapped without a difference in what skjalasafn.reykjavik.is
+    sees. Must be created and closed inside the running event loop.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+        read_timeout: float = READ_TIMEOUT_SECONDS,
+        pool_maxsize: int = POOL_MAXSIZE,
+        cache: ResponseCache | None = None,
+    ):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+        self._session = aiohttp.ClientSession(
+            headers=HEADERS,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=connect_timeout, sock_read=read_timeout
+            ),
+            connector=aiohttp.TCPConnector(limit=pool_maxsize),
+            trace_configs=[trace_config],
+        )
+        self._cache = cache
+        self._requests = 0
+        self._connections = 0
+        self._bytes_received = 0
+        self._not_modified = 0
+        self._retries = 0
+
+    async def _on_connection_created(self, session, context, params) -> None:
+        self._connections += 1
+
+    async def get(
+        self,
+        url: str,
+        pacer: AdaptivePacer | None = None,
+        headers: dict | None = None,
+    ) -> Response:
+        """Retries the way `HttpClient.get` does, without blocking the loop"""
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = await self._get(url, headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                is_response_error = isinstance(e, aiohttp.ClientResponseError)
+                status = e.status if is_response_error else None
+                if pacer is None or not is_retryable(status):
+                    raise
+                attempt += 1
+                self._retries += 1
+                pacer.record_failure()
+                retry_after = (
+                    parse_retry_after(e.headers.get("Retry-After"))
+                    if is_response_error and e.headers is not None
+                    else None
+                )
+                wait = pacer.backoff(attempt, retry_after)
+                logger.warning(f"Fetching {url} failed ({e!r}), retry in {wait:.1f}s")
+                await asyncio.sleep(wait)
+                continue
+
+            if pacer is not None:
+                pacer.record_success(time.monotonic() - start)
+            return response
+
+    async def get_page(self, url: str, pacer: AdaptivePacer | None = None) -> Page:
+        """See `HttpClient.get_page`"""
+        if self._cache is None:
+            body = (await self.get(url, pacer)).body
+            return Page(body, content_hash(body), False)
+
+        entry = self._cache.lookup(url)
+        headers = {}
+        if entry is not None and entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+
+        response = await self.get(url, pacer, headers)
+        if response.status == 304:
+            body = self._cache.read_body(url)
+            if body is not None:
+                return Page(body, entry.content_hash, True)
+            # Evicted since the lookup, fetch it again without validators
+            response = await self.get(url, pacer)
+
+        body_hash = self._cache.store(
+            url,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            response.body,
+        )
+        return Page(
+            response.body,
+            body_hash,
+            entry is not None and entry.content_hash == body_hash,
+        )
+
+    async def _get(self, url: str, headers: dict | None = None) -> Response:
+        async with self._session.get(url, headers=headers) as response:
+            body = await response.read()
+            self._requests += 1
+            self._bytes_received += len(body)
+            if response.status == 304:
+                self._not_modified += 1
+            response.raise_for_status()
+            return Response(response.status, response.headers, body)
+
+    def stats(self) -> ClientStats:
+        return ClientStats(
+            requests=self._requests,
+            connections=self._connections,
+            reused=self._requests - self._connections,
+            bytes_received=self._bytes_received,
+            not_modified=self._not_modified,
+            retries=self._retries,
+        )
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.info(
+            f"HTTP requests: {stats.requests}, connections: {stats.connections}, "
+            f"reused: {stats.reused}, bytes received: {stats.bytes_received}, "
+            f"not modified: {stats.not_modified}, retries: {stats.retries}"
+        )
+
+    async def close(self) -> None:
+        await self._session.close()
+        if self._cache is not None:
+            self._cache.close()
@@ -0,0 +1,237 @@
+"""
+Micro-benchmark of address parsing, comparing address_parsing with the
+implementations that were copied between the scripts before it existed.
+
+    python benchmarks/bench_address_parsing.py [--records 200000]
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import address_parsing  # noqa: E402
+
+ADDRESSES = [
+    "Básbryggja 19-21 Naustabryggja 24",
+    "Dragháls 18-26 18",
+    "Eirhöfði 8 Breiðhöfði 15",
+    "Gullengi 11*",
+    "Hæðargarður 27 A",
+    "Klapparstígur 1- 7",
+    "Laugavegur 22 -Klapparstígur 33",
+    "Ljósaland 1-25 10",
+    "Naustabryggja 55- 57",
+    "Skeifan 15, Faxafen 8",
+    "Skrauthólar 5 vegsvæði Vesturlandsvegar",
+    "Smábýli 12 vegsvæði",
+    "Sundahöfn 1.3, 1.4",
+    "Ártún vegsvæði 2 hliðarvegar",
+    "Fossháls 13-15 - Dragháls 14-16",
+    "Thorvaldsenstræti 2-6/Aðalstræti 11",
+    "Laugavegur 60A",
+    "Kleppsvegur Bensínstöð",
+    "Þórsgata  3",
+    "Ystibær 9",
+]
+
+# What parse_address makes of the edge cases in its docstring, where that
+# differs from the legacy implementation
+EDGE_CASES = {
+    "Básbryggja 19-21 Naustabryggja 24": (
+        "Básbryggja 19",
+        "Básbryggja 21",
+        "Naustabryggja 24",
+    ),
+    "Dragháls 18-26 18": ("Dragháls 18",),
+    "Eirhöfði 8 Breiðhöfði 15": ("Breiðhöfði 15", "Eirhöfði 8"),
+    "Gullengi 11*": ("Gullengi 11",),
+    "Hæðargarður 27 A": ("Hæðargarður 27A",),
+    "Klapparstígur 1- 7": (
+        "Klapparstígur 1",
+        "Klapparstígur 3",
+        "Klapparstígur 5",
+        "Klapparstígur 7",
+    ),
+    "Laugavegur 22 -Klapparstígur 33": ("Klapparstígur 33", "Laugavegur 22"),
+    "Ljósaland 1-25 10": ("Ljósaland 10",),
+    "Naustabryggja 55- 57": ("Naustabryggja 55", "Naustabryggja 57"),
+    "Skeifan 15, Faxafen 8": ("Faxafen 8", "Skeifan 15"),
+    "Sundahöfn 1.3, 1.4": ("Sundahöfn 1.3", "Sundahöfn 1.4"),
+    "Laugavegur 60a": ("Laugavegur 60A",),
+    "Skipholt 17a": ("Skipholt 17A",),
+    "eDDUFELL 8": ("Eddufell 8",),
+    "ySTIBÆR 9": ("Ystibær 9",),
+    "Kleppsvegur Bensínstöð": ("Kleppsvegur bensínstöð",),
+    "Kleppsvegur bensínstöð": ("Kleppsvegur bensínstöð",),
+}
+
+STREETS = ["Laugavegur", "Skólavörðustígur", "Hverfisgata", "Bergþórugata", "Ægisíða"]
+
+
+def legacy_single_space(address: str) -> str:
+    return " ".join(part for part in address.split(" ") if part != "")
+
+
+def legacy_parse_address(address: str) -> set[str]:
+    if " - " in address:
+        addresses = address.split(" - ")
+    elif "/" in address:
+        addresses = address.split("/")
+    else:
+        addresses = [address]
+
+    return_addresses = set()
+    for addr in addresses:
+        addr_strip = addr.strip()
+        match = re.match(r"(?P<street_name>.*) (?P<start>\d+)-(?P<end>\d+)", addr_strip)
+        if match:
+            groupdict = match.groupdict()
+            street_name = groupdict["street_name"]
+            start = int(groupdict["start"])
+            end = int(groupdict["end"])
+            while start <= end:
+                return_addresses.add(legacy_single_space(f"{street_name} {start}"))
+                start += 2
+        else:
+            return_addresses.add(legacy_single_space(addr_strip))
+
+    return return_addresses
+
+
+def legacy_convert_image(img):
+    meta = img["metadata"]
+    if "210" in meta:
+        address = meta["210"]["value"].strip()
+    else:
+        address = f"{meta['203']['value'].strip()} {meta['204']['value'].strip()}"
+    parsed_addresses = legacy_parse_address(address)
+    if "214" in meta:
+        description = meta["214"]["value"].strip()
+    else:
+        description = "[Lýsingu vantar]"
+
+    date = meta["30"]["value"].strip() if "30" in meta else None
+    hash = hashlib.md5(img["href"].encode()).hexdigest()[:7]
+
+    data = {
+        "address": address,
+        "date": date,
+        "description": description,
+        "hash": hash,
+        "images": {preview["size"]: preview for preview in img["previews"]},
+        "originalHref": img["href"],
+    }
+    return parsed_addresses, data
+
+
+TRANSLATE_TABLE = str.maketrans(
+    {"á": "a", "é": "e", "í": "i", "ó": "o", "ú": "u"}
+    | {"ý": "y", "þ": "t", "æ": "ae", "ö": "o", "ð": "d"}
+)
+
+
+def translate_normalize(address):
+    return address.lower().translate(TRANSLATE_TABLE)
+
+
+def legacy_normalize(address):
+    return (
+        address.lower()
+        .replace("á", "a")
+        .replace("é", "e")
+        .replace("í", "i")
+        .replace("ó", "o")
+        .replace("ú", "u")
+        .replace("ý", "y")
+        .replace("þ", "t")
+        .replace("æ", "ae")
+        .replace("ö", "o")
+        .replace("ð", "d")
+    )
+
+
+def make_images(count: int) -> list[dict]:
+    """Assets with addresses repeating the way they do in the archive"""
+    rng = random.Random(0)
+    addresses = ADDRESSES + [
+        f"{street} {number}" for street in STREETS for number in range(1, 200)
+    ]
+    images = []
+    for i in range(count):
+        metadata = {
+            "30": {"value": f"{rng.randint(1900, 2020)}-01-01"},
+            "214": {"value": "Grunnmynd"},
+        }
+        if i % 4 == 0:
+            street, number = rng.choice(STREETS), rng.randint(1, 200)
+            metadata["203"] = {"value": street}
+            metadata["204"] = {"value": str(number)}
+        else:
+            metadata["210"] = {"value": rng.choice(addresses)}
+        images.append(
+            {
+                "href": f"/fotoweb/archives/5001/{i}.tif.info",
+                "metadata": metadata,
+                "previews": [{"size": 400, "href": f"/p/{i}/400"}],
+            }
+        )
+    return images
+
+
+def bench(name: str, function, items: list) -> float:
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {len(items) / elapsed:>12,.0f} /s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200000)
+    args = parser.parse_args()
+
+    images = make_images(args.records)
+    addresses = [
+        img["metadata"].get("210", {"value": "Laugavegur 1"})["value"]
+        for img in images
+    ]
+
+    for address, expected in EDGE_CASES.items():
+        assert address_parsing.parse_address(address) == expected, address
+    for img in images[:1000]:
+        new_addresses, new_data = address_parsing.convert_image(img)
+        old_addresses, old_data = legacy_convert_image(img)
+        assert new_data == old_data
+        if new_data["address"] not in EDGE_CASES:
+            assert set(new_addresses) == old_addresses
+    for address in addresses[:1000]:
+        assert address_parsing.normalize(address) == legacy_normalize(address)
+        assert translate_normalize(address) == legacy_normalize(address)
+
+    print(f"{args.records} records")
+    cases = [
+        ("parse_address", legacy_parse_address, address_parsing.parse_address),
+        ("normalize", legacy_normalize, address_parsing.normalize),
+        ("convert_image", legacy_convert_image, address_parsing.convert_image),
+    ]
+    for label, legacy, current in cases:
+        items = images if label == "convert_image" else addresses
+        address_parsing.parse_address.cache_clear()
+        old = bench(f"{label} (legacy)", legacy, items)
+        new = bench(f"{label}", current, items)
+        print(f"{'':<28} {old / new:>12.1f}x")
+
+    # Kept for comparison, str.translate loses to the replace chain here
+    bench("normalize (str.translate)", translate_normalize, addresses)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,470 @@
+"""
+End-to-end benchmark of the scrape -> sculpt -> upload pipeline.
+
+Synthetic FotoWeb assetlist pages are served from a local HTTP stub and
+uploads go to a local S3 stand-in, so nothing leaves the machine. Every
+stage runs in its own process so its peak RSS can be reported separately.
+
+    python benchmarks/bench_pipeline.py --pages 100,1000 [--json results.json]
+
+Use --s3-endpoint to upload to another S3 compatible server, such as MinIO,
+instead of the built-in stand-in.
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape, unescape
+
+SCRAPER_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, SCRAPER_DIR)
+
+PAGE_SIZE = 25
+BUCKET_NAME = "bench"
+STREETS = [
+    "Laugavegur",
+    "Skólavörðustígur",
+    "Hverfisgata",
+    "Þórsgata",
+    "Ægisíða",
+    "Bergþórugata",
+    "Njálsgata",
+    "Grettisgata",
+]
+PREVIEW_SIZES = [200, 400, 800, 1600, 2400]
+
+
+def load_script(name: str):
+    """Import one of the hyphenated cron scripts as a module"""
+    path = os.path.join(SCRAPER_DIR, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_asset(rng: random.Random, index: int) -> dict:
+    street = rng.choice(STREETS)
+    number = rng.randint(1, 120)
+    metadata = {
+        "30": {"value": f"{rng.randint(1900, 2020)}-{rng.randint(1, 12):02d}-01"},
+        "214": {"value": rng.choice(["Grunnmynd", "Útlit", "Snið", "Afstöðumynd"])},
+    }
+    if rng.random() < 0.2:
+        metadata["203"] = {"value": street}
+        metadata["204"] = {"value": str(number)}
+    elif rng.random() < 0.2:
+        metadata["210"] = {"value": f"{street} {number}-{number + 4}"}
+    else:
+        metadata["210"] = {"value": f"{street} {number}"}
+
+    href = f"/fotoweb/archives/5000-Aðaluppdrættir/Adaluppdraettir/{index}.tif.info"
+    return {
+        "href": href,
+        "metadata": metadata,
+        "previews": [
+            {
+                "size": size,
+                "width": size,
+                "height": size * 3 // 4,
+                "href": f"/fotoweb/cache/5000/Adaluppdraettir/{index}.t{size}.jpg",
+                "square": False,
+            }
+            for size in PREVIEW_SIZES
+        ],
+    }
+
+
+def make_pages(page_count: int) -> list[list[dict]]:
+    """Pages of the descending listing, newest asset first"""
+    rng = random.Random(page_count)
+    assets = [make_asset(rng, index) for index in range(page_count * PAGE_SIZE)]
+    assets.reverse()
+    return [assets[i : i + PAGE_SIZE] for i in range(0, len(assets), PAGE_SIZE)]
+
+
+def write_stadfangaskra(path: str) -> None:
+    with open(path, "w") as f:
+        f.write("POSTNR,HEITI_NF,HUSNR,N_HNIT_WGS84,E_HNIT_WGS84\n")
+        for i, street in enumerate(STREETS):
+            for number in range(1, 130):
+                lat = 64.14 - i * 0.003 + number * 0.00002
+                lng = -21.94 + i * 0.004 + number * 0.00003
+                f.write(f"101,{street},{number},{lat},{lng}\n")
+
+
+class FotoWebStub(ThreadingHTTPServer):
+    """
+    Serves /desc/<page> and /asc/<page> the way FotoWeb serves the assetlist
+    in both orders, with ETags so conditional requests work.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, pages: list[list[dict]]):
+        super().__init__(("127.0.0.1", 0), FotoWebHandler)
+        self.pages = pages
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FotoWebHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, without this every
+    # keep-alive response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        match = re.fullmatch(r"/(desc|asc)/(\d+)", self.path)
+        if match is None:
+            self.send_error(404)
+            return
+
+        order, page = match[1], int(match[2])
+        pages = self.server.pages
+        if page < len(pages):
+            index = page if order == "desc" else len(pages) - 1 - page
+            data = pages[index] if order == "desc" else pages[index][::-1]
+        else:
+            data = []
+        body = json.dumps(
+            {"data": data, "paging": {"next": f"/{order}/{page + 1}"}}
+        ).encode()
+
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.fotoware.assetlist+json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class S3Stub(ThreadingHTTPServer):
+    """
+    The part of the S3 API the uploader uses: PutObject, DeleteObjects and
+    ListObjectsV2, with path style addressing and objects kept in memory.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), S3Handler)
+        self.objects = {}
+        self.operations = 0
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _key(self) -> str:
+        path = unquote(urlparse(self.path).path)
+        return path[len(f"/{BUCKET_NAME}/") :]
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, status: int, body: bytes = b"", headers: dict = {}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self._body()
+        with self.server.lock:
+            self.server.operations += 1
+            self.server.objects[self._key()] = body
+        self._reply(200, headers={"ETag": '"' + hashlib.md5(body).hexdigest() + '"'})
+
+    def do_POST(self):
+        body = self._body().decode()
+        keys = [unescape(key) for key in re.findall(r"<Key>(.*?)</Key>", body)]
+        with self.server.lock:
+            self.server.operations += 1
+            for key in keys:
+                self.server.objects.pop(key, None)
+        deleted = "".join(
+            f"<Deleted><Key>{escape(key)}</Key></Deleted>" for key in keys
+        )
+        self._reply(200, f"<DeleteResult>{deleted}</DeleteResult>".encode())
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        prefix = query.get("prefix", [""])[0]
+        start = query.get("continuation-token", [""])[0]
+        with self.server.lock:
+            self.server.operations += 1
+            keys = sorted(
+                key
+                for key in self.server.objects
+                if key.startswith(prefix) and key > start
+            )
+        page, truncated = keys[:1000], len(keys) > 1000
+        contents = "".join(
+            f"<Contents><Key>{escape(key)}</Key><Size>0</Size></Contents>"
+            for key in page
+        )
+        next_token = (
+            f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>"
+            if truncated
+            else ""
+        )
+        body = (
+            f"<ListBucketResult><Name>{BUCKET_NAME}</Name>"
+            f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+            f"<IsTruncated>{str(truncated).lower()}</IsTruncated>"
+            f"{next_token}{contents}</ListBucketResult>"
+        )
+        self._reply(200, body.encode(), {"Content-Type": "application/xml"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ScrapeFinished(Exception):
+    pass
+
+
+def run_scrape(work_dir: str, base_url: str) -> dict:
+    cron_scraper = load_script("cron-scraper")
+    from http_client import HttpClient
+    from pacing import AdaptivePacer
+
+    cron_scraper.BASE_URL = base_url
+    cron_scraper.SCRAPE_URLS[cron_scraper.CURSOR_DESCENDING] = f"{base_url}/desc/0"
+    cron_scraper.SCRAPE_URLS[cron_scraper.CURSOR_ASCENDING] = f"{base_url}/asc/0"
+
+    data_dir = os.path.join(work_dir, "data")
+    os.makedirs(data_dir)
+    client = HttpClient()
+    pacer = AdaptivePacer(
+        initial_delay=0, min_delay=0, max_delay=1, target_latency=1, max_retries=3
+    )
+    # scrape() keeps going until its time is up, stop it as soon as the first
+    # full scrape has been materialized and moved to data/last
+    rename_current_scrape_dir = cron_scraper.rename_current_scrape_dir
+
+    def rename_and_stop(data_dir, scrape_id):
+        rename_current_scrape_dir(data_dir, scrape_id)
+        raise ScrapeFinished()
+
+    cron_scraper.rename_current_scrape_dir = rename_and_stop
+    start = time.perf_counter()
+    try:
+        cron_scraper.scrape(client, pacer, 24 * 3600, data_dir, 24 * 7)
+    except ScrapeFinished:
+        pass
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    from address_stats import read_stats
+
+    stats = read_stats(os.path.join(data_dir, "last"))
+    return {"elapsed": elapsed, "records": sum(s["count"] for s in stats.values())}
+
+
+def run_sculptor(work_dir: str, pages: list[list[dict]]) -> dict:
+    from raw_archive import ArchiveWriter
+
+    sculptor_dir = os.path.join(work_dir, "sculptor")
+    writer = ArchiveWriter(os.path.join(sculptor_dir, "scrape"))
+    for page, data in enumerate(pages):
+        writer.write_page(page, {"data": data, "paging": {}})
+    write_stadfangaskra(os.path.join(sculptor_dir, "Stadfangaskra.csv"))
+
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(SCRAPER_DIR, "sculptor.py"), "scrape"],
+        cwd=sculptor_dir,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"elapsed": elapsed, "peak_rss_kb": peak_kb}
+
+
+def run_upload(work_dir: str, endpoint_url: str) -> dict:
+    import boto3
+
+    cron_uploader = load_script("cron-uploader")
+    data_dir = os.path.join(work_dir, "data")
+    write_stadfangaskra(os.path.join(data_dir, "Stadfangaskra.csv"))
+    s3_client = boto3.client(
+        service_name="s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id="bench",
+        aws_secret_access_key="bench",
+        region_name="us-east-1",
+    )
+    uploader = cron_uploader.Uploader(s3_client, BUCKET_NAME, "bench")
+    start = time.perf_counter()
+    try:
+        cron_uploader.process(cron_uploader.Paths(data_dir), uploader)
+    finally:
+        uploader.close()
+    return {"elapsed": time.perf_counter() - start}
+
+
+def run_stage(args) -> None:
+    """Entry point of the per-stage child processes"""
+    if args.stage == "scrape":
+        result = run_scrape(args.work_dir, args.url)
+    elif args.stage == "sculptor":
+        result = run_sculptor(args.work_dir, make_pages(args.page_count))
+    else:
+        result = run_upload(args.work_dir, args.url)
+    result.setdefault(
+        "peak_rss_kb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    )
+    print(json.dumps(result))
+
+
+def stage(name: str, work_dir: str, page_count: int, url: str = "") -> dict:
+    output = subprocess.run(
+        [
+            sys.executable,
+            __file__,
+            "--stage",
+            name,
+            "--work-dir",
+            work_dir,
+            "--page-count",
+            str(page_count),
+            "--url",
+            url,
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench(page_count: int, s3_endpoint: str | None) -> dict:
+    pages = make_pages(page_count)
+    assets = sum(len(page) for page in pages)
+    fotoweb = FotoWebStub(pages)
+    s3 = S3Stub()
+    for server in (fotoweb, s3):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    try:
+        scrape = stage("scrape", work_dir, page_count, fotoweb.base_url)
+        sculptor = stage("sculptor", work_dir, page_count)
+        upload = stage("upload", work_dir, page_count, s3_endpoint or s3.endpoint_url)
+    finally:
+        fotoweb.shutdown()
+        s3.shutdown()
+        shutil.rmtree(work_dir)
+
+    return {
+        "pages": page_count,
+        "assets": assets,
+        "scrape": {
+            "pages_per_second": fotoweb.requests / scrape["elapsed"],
+            "records_per_second": scrape["records"] / scrape["elapsed"],
+            **scrape,
+        },
+        "sculptor": {"records_per_second": assets / sculptor["elapsed"], **sculptor},
+        "upload": {
+            "operations": s3.operations,
+            "operations_per_second": s3.operations / upload["elapsed"],
+            **upload,
+        },
+    }
+
+
+def report(result: dict) -> None:
+    scrape, sculptor, upload = result["scrape"], result["sculptor"], result["upload"]
+    print(f"{result['pages']} pages, {result['assets']} assets")
+    print(
+        f"  scrape    {scrape['elapsed']:8.2f}s  "
+        f"{scrape['pages_per_second']:10.1f} pages/s  "
+        f"{scrape['records_per_second']:10.1f} records/s  "
+        f"peak RSS {scrape['peak_rss_kb'] / 1024:.0f} MB"
+    )
+    print(
+        f"  sculptor  {sculptor['elapsed']:8.2f}s  "
+        f"{sculptor['records_per_second']:10.1f} records/s  "
+        f"peak RSS {sculptor['peak_rss_kb'] / 1024:.0f} MB"
+    )
+    print(
+        f"  upload    {upload['elapsed']:8.2f}s  "
+        f"{upload['operations_per_second']:10.1f} ops/s  "
+        f"({upload['operations']} ops)  "
+        f"peak RSS {upload['peak_rss_kb'] / 1024:.0f} MB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--pages",
+        default="100,1000",
+        help="Comma separated archive sizes in pages of 25 assets",
+    )
+    parser.add_argument("--s3-endpoint", help="Upload here instead of the stand-in")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--page-count", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage is not None:
+        run_stage(args)
+        return
+
+    results = []
+    for page_count in [int(pages) for pages in args.pages.split(",")]:
+        result = bench(page_count, args.s3_endpoint)
+        report(result)
+        results.append(result)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import csv
+import hashlib
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CoordStore:
+    """
+    Coordinates from Stadfangaskra.csv compiled into a SQLite file keyed by
+    address, next to the CSV. The file is rebuilt only when the CSV changes:
+    size and mtime are checked on open, and the CSV is only hashed when they
+    differ, so an unchanged touch of the CSV does not trigger a rebuild.
+    """
+
+    def __init__(self, csv_path: str, db_path: str | None = None):
+        self._csv_path = str(csv_path)
+        self._db_path = db_path or self._csv_path + ".sqlite3"
+        self._conn = self._open()
+
+    def _open(self) -> sqlite3.Connection:
+        stat = os.stat(self._csv_path)
+        if os.path.exists(self._db_path):
+            conn = sqlite3.connect(self._db_path)
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            if meta["size"] == str(stat.st_size) and meta["mtime"] == str(
+                stat.st_mtime_ns
+            ):
+                return conn
+
+            csv_hash = file_sha256(self._csv_path)
+            if meta["hash"] == csv_hash:
+                with conn:
+                    conn.executemany(
+                        "UPDATE meta SET value = ? WHERE key = ?",
+                        [(str(stat.st_size), "size"), (str(stat.st_mtime_ns), "mtime")],
+                    )
+                return conn
+            conn.close()
+        else:
+            csv_hash = file_sha256(self._csv_path)
+
+        self._build(stat, csv_hash)
+        return sqlite3.connect(self._db_path)
+
+    def _build(self, stat: os.stat_result, csv_hash: str) -> None:
+        logger.info(f"Compiling {self._csv_path} to {self._db_path}")
+        # Build next to the final file and swap it in, so a reader never sees
+        # a half-built store
+        tmp_path = f"{self._db_path}.{os.getpid()}.tmp"
+        conn = sqlite3.connect(tmp_path)
+        with conn:
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(
+                "CREATE TABLE coords (address TEXT PRIMARY KEY, lat REAL, lng REAL)"
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO coords VALUES (?, ?, ?)",
+                read_csv_coords(self._csv_path),
+            )
+            conn.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [
+                    ("size", str(stat.st_size)),
+                    ("mtime", str(stat.st_mtime_ns)),
+                    ("hash", csv_hash),
+                ],
+            )
+        conn.close()
+        os.replace(tmp_path, self._db_path)
+
+    def get(self, address: str) -> list[float] | None:
+        row = self._conn.execute(
+            "SELECT lat, lng FROM coords WHERE address = ?", (address,)
+        ).fetchone()
+        return list(row) if row is not None else None
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def read_csv_coords(csv_path: str):
+    """Yield (address, lat, lng) for the addresses in Reykjavík"""
+    with open(csv_path) as f:
+        for row in csv.DictReader(f):
+            if row["POSTNR"] != "" and int(row["POSTNR"]) < 200:
+                address = f"{row['HEITI_NF']} {row['HUSNR']}"
+                yield address, float(row["N_HNIT_WGS84"]), float(row["E_HNIT_WGS84"])
@@ -1,60 +1,105 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import logging
 from collections import namedtuple
 import configparser
 import json
 import time
-import requests
 from datetime import datetime
 import os
-import hashlib
-import re
+import shutil
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from address_parsing import convert_image
+from address_stats import content_stats, file_stats, read_stats, write_stats
+from artifacts import compact_dumps
+import async_http_client
+from async_http_client import AsyncHttpClient
+from http_client import HttpClient, Page
+from metrics import Metrics, profiling
+from pacing import AdaptivePacer
+from response_cache import ResponseCache
+from single_instance import AlreadyRunning, single_instance
+from staging import HrefCatalog, StagingStore
 
 logger = logging.getLogger(__name__)
 
 
 PHASE_RESTART = "restart"
+PHASE_FETCH = "fetch"
+# Phases of scrapes started before the cursors ran side by side
 PHASE_FETCH_DESCENDING = "fetch-descending"
 PHASE_FETCH_ASCENDING = "fetch-ascending"
 
-DATE_KEY = "30"
-STREET_NAME_KEY = "203"
-HOUSE_NUMBER_KEY = "204"
-ADDRESS_KEY = "210"
-DESCRIPTION_KEY = "214"
+CURSOR_DESCENDING = "descending"
+CURSOR_ASCENDING = "ascending"
+CURSOR_ORDER = (CURSOR_DESCENDING, CURSOR_ASCENDING)
 
+MODE_FULL = "full"
+MODE_INCREMENTAL = "incremental"
 
-def get_next_phase(phase: str) -> str:
-    if phase == PHASE_RESTART:
-        return PHASE_FETCH_DESCENDING
-    elif phase == PHASE_FETCH_DESCENDING:
-        return PHASE_FETCH_ASCENDING
-    elif phase == PHASE_FETCH_ASCENDING:
-        return PHASE_RESTART
-    else:
-        raise RuntimeError()
+ENGINE_SYNC = "sync"
+ENGINE_ASYNC = "async"
 
 
 BASE_URL = "https://skjalasafn.reykjavik.is"
 SCRAPE_URLS = {
-    PHASE_FETCH_DESCENDING: "https://skjalasafn.reykjavik.is/fotoweb/archives/5000-A%C3%B0aluppdr%C3%A6ttir/",
-    PHASE_FETCH_ASCENDING: "https://skjalasafn.reykjavik.is/fotoweb/archives/5000-A%C3%B0aluppdr%C3%A6ttir/;o=+",
-    PHASE_RESTART: "",
+    CURSOR_DESCENDING: "https://skjalasafn.reykjavik.is/fotoweb/archives/5000-A%C3%B0aluppdr%C3%A6ttir/",
+    CURSOR_ASCENDING: "https://skjalasafn.reykjavik.is/fotoweb/archives/5000-A%C3%B0aluppdr%C3%A6ttir/;o=+",
 }
 
+
+def start_cursors(mode: str) -> dict[str, str]:
+    """
+    A full scrape walks the listing from both ends at once until the two
+    cursors meet. New drawings show up first in the descending listing, an
+    incremental scrape has nothing to gain from the ascending one.
+    """
+    if mode == MODE_INCREMENTAL:
+        return {CURSOR_DESCENDING: SCRAPE_URLS[CURSOR_DESCENDING]}
+    return {cursor: SCRAPE_URLS[cursor] for cursor in CURSOR_ORDER}
+
+
 EMPTY_STATUS = {
     "scrape_id": None,
     "phase": PHASE_RESTART,
-    "next_url": None,
+    "cursors": {},
+    "mode": MODE_FULL,
+    "last_full_scrape": None,
 }
 STATUSFILE = "status.json"
-HEADERS = {"Accept": "application/vnd.fotoware.assetlist+json, */*; q=0.01"}
+LOCKFILE = "scraper.lock"
+STAGING_FILENAME = "staging.sqlite3"
+CATALOG_FILENAME = "catalog.sqlite3"
+SNAPSHOT_DIRNAME = "snapshot"
 
 Config = namedtuple(
-    "Config", "run_for_seconds sleep_milliseconds logfile data_dir log_to_stderr"
+    "Config",
+    """
+        run_for_seconds
+        sleep_milliseconds
+        min_sleep_milliseconds
+        max_sleep_milliseconds
+        target_latency_milliseconds
+        max_retries
+        logfile
+        data_dir
+        log_to_stderr
+        full_scrape_interval_hours
+        cache_dir
+        cache_max_megabytes
+        connect_timeout_seconds
+        read_timeout_seconds
+        metrics_dir
+        profile
+        checkpoint_pages
+        checkpoint_seconds
+        engine
+    """,
 )
 
 
@@ -64,16 +109,66 @@ def read_config(configfile: str) -> Config:
     config = Config(
         run_for_seconds=parser.getint("scrape", "run_for_seconds"),
         sleep_milliseconds=parser.getint("scrape", "sleep_milliseconds"),
+        min_sleep_milliseconds=parser.getint(
+            "scrape", "min_sleep_milliseconds", fallback=500
+        ),
+        max_sleep_milliseconds=parser.getint(
+            "scrape", "max_sleep_milliseconds", fallback=60000
+        ),
+        target_latency_milliseconds=parser.getint(
+            "scrape", "target_latency_milliseconds", fallback=2000
+        ),
+        max_retries=parser.getint("scrape", "max_retries", fallback=5),
         logfile=parser.get("scrape", "logfile"),
         data_dir=parser.get("scrape", "data_dir"),
         log_to_stderr=parser.get("scrape", "log_to_stderr", fallback="false"),
+        full_scrape_interval_hours=parser.getfloat(
+            "scrape", "full_scrape_interval_hours", fallback=168
+        ),
+        cache_dir=parser.get("scrape", "cache_dir", fallback=None),
+        cache_max_megabytes=parser.getint(
+            "scrape", "cache_max_megabytes", fallback=256
+        ),
+        connect_timeout_seconds=parser.getfloat(
+            "scrape", "connect_timeout_seconds", fallback=10
+        ),
+        read_timeout_seconds=parser.getfloat(
+            "scrape", "read_timeout_seconds", fallback=60
+        ),
+        metrics_dir=parser.get("scrape", "metrics_dir", fallback=None),
+        profile=parser.getboolean("scrape", "profile", fallback=False),
+        checkpoint_pages=parser.getint("scrape", "checkpoint_pages", fallback=20),
+        checkpoint_seconds=parser.getfloat(
+            "scrape", "checkpoint_seconds", fallback=30
+        ),
+        engine=parser.get("scrape", "engine", fallback=ENGINE_SYNC),
     )
     return config
 
 
-def init_scrape(data_dir: str) -> dict:
+def choose_engine(engine: str) -> str:
+    if engine not in (ENGINE_SYNC, ENGINE_ASYNC):
+        raise ValueError(f"Unknown engine {engine}")
+    if engine == ENGINE_ASYNC and async_http_client.aiohttp is None:
+        logger.warning("aiohttp is not installed, using the sync engine")
+        return ENGINE_SYNC
+    return engine
+
+
+def choose_mode(
+    data_dir: str, last_full_scrape: float | None, full_scrape_interval_hours: float
+) -> str:
+    snapshot_dir = os.path.join(data_dir, SNAPSHOT_DIRNAME)
+    if not os.path.exists(snapshot_dir) or last_full_scrape is None:
+        return MODE_FULL
+    if time.time() - last_full_scrape >= full_scrape_interval_hours * 3600:
+        return MODE_FULL
+    return MODE_INCREMENTAL
+
+
+def init_scrape(data_dir: str, mode: str, last_full_scrape: float | None) -> dict:
     scrape_id = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    logger.info(f"Initializing scrape {scrape_id}")
+    logger.info(f"Initializing {mode} scrape {scrape_id}")
     basepath = os.path.join(data_dir, scrape_id)
 
     addresses_dir = os.path.join(basepath, "addresses")
@@ -81,12 +176,20 @@ def init_scrape(data_dir: str) -> dict:
 
     status = EMPTY_STATUS.copy()
     status["scrape_id"] = scrape_id
+    status["mode"] = mode
+    status["last_full_scrape"] = last_full_scrape
     return status
 
 
 def write_statusfile(status: dict, statusfile: str) -> None:
-    with open(statusfile, "w") as f:
+    # Written to a temporary file and renamed, a crash leaves either the old
+    # or the new status but never a truncated one
+    tmp_path = statusfile + ".tmp"
+    with open(tmp_path, "w") as f:
         json.dump(status, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, statusfile)
 
 
 def read_statusfile(statusfile: str) -> dict:
@@ -94,211 +197,678 @@ def read_statusfile(statusfile: str) -> dict:
         return json.load(f)
 
 
-def fetch(url):
+def fetch(client: HttpClient, pacer: AdaptivePacer, url: str) -> Page:
     logger.info(f"Fetching {url}")
-    response = requests.get(url, headers=HEADERS)
-    response.raise_for_status()
-    return response.json()
+    return client.get_page(url, pacer)
 
 
-def rename_current_scrape_dir(data_dir, scrape_id):
-    scrape_dir = os.path.join(data_dir, scrape_id)
+def check_last_dir_free(data_dir: str) -> None:
     last_dir = os.path.join(data_dir, "last")
     if os.path.exists(last_dir):
         raise Exception(f"Can not rename current scrape dir, {last_dir} exists")
 
+
+def rename_current_scrape_dir(data_dir, scrape_id):
+    scrape_dir = os.path.join(data_dir, scrape_id)
+    last_dir = os.path.join(data_dir, "last")
+    check_last_dir_free(data_dir)
+
     if os.path.exists(scrape_dir):
         logger.info(f"Renaming current scrape dir: {scrape_dir} -> {last_dir}")
         os.rename(scrape_dir, last_dir)
 
 
-def append_data(data_dir: str, status: dict, address: str, img_data: dict) -> None:
-    address_file = os.path.join(
-        data_dir, status["scrape_id"], "addresses", f"{address}.json"
-    )
-    if os.path.exists(address_file):
-        with open(address_file) as f:
-            address_list = json.load(f)
-    else:
-        address_list = []
-
-    address_list.append(img_data)
-
-    with open(address_file, "w") as f:
-        json.dump(address_list, f)
-
-
-def single_space(address: str) -> str:
-    return " ".join(part for part in address.split(" ") if part != "")
-
-
-def parse_address(address: str, href: str) -> list[str]:
+def open_staging_store(data_dir: str, scrape_id: str) -> StagingStore:
+    scrape_dir = os.path.join(data_dir, scrape_id)
+    staging_file = os.path.join(scrape_dir, STAGING_FILENAME)
+    is_new = not os.path.exists(staging_file)
+    store = StagingStore(staging_file)
+
+    addresses_dir = os.path.join(scrape_dir, "addresses")
+    if is_new and os.listdir(addresses_dir):
+        # Scrape started before the staging store existed, move its address
+        # files into the store so they are materialized with the rest
+        logger.info(f"Importing existing address files into {staging_file}")
+        rows = []
+        for filename in os.listdir(addresses_dir):
+            with open(os.path.join(addresses_dir, filename), encoding="utf-8") as f:
+                rows.extend((filename[:-5], img_data) for img_data in json.load(f))
+        store.append_many(rows, (img_data["originalHref"] for _, img_data in rows))
+        for filename in os.listdir(addresses_dir):
+            os.remove(os.path.join(addresses_dir, filename))
+
+    return store
+
+
+def write_address_file(address_file: str, records: list[str]) -> dict:
+    """Write the records and return the stats of the written file"""
+    content = ("[" + ",".join(records) + "]").encode()
+    # Address files are hard linked into the snapshot, replace them instead
+    # of writing in place so the snapshot is never modified through a link
+    tmp_file = address_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(content)
+    os.replace(tmp_file, address_file)
+    return content_stats(content, [json.loads(record) for record in records])
+
+
+def merge_records(address_file: str, records: list[str]) -> list[str]:
+    with open(address_file, encoding="utf-8") as f:
+        existing = json.load(f)
+    known_hrefs = set(img_data["originalHref"] for img_data in existing)
+    merged = [compact_dumps(img_data) for img_data in existing]
+    for record in records:
+        if json.loads(record)["originalHref"] not in known_hrefs:
+            merged.append(record)
+    return merged
+
+
+def link_tree(source_dir: str, target_dir: str) -> None:
+    for filename in os.listdir(source_dir):
+        target = os.path.join(target_dir, filename)
+        if not os.path.exists(target):
+            os.link(os.path.join(source_dir, filename), target)
+
+
+def materialize_addresses(data_dir: str, scrape_id: str, mode: str) -> int:
     """
-    Check: what's the usual case for 2A or 2a? Uppercase or lowercase?
-    Edge cases:
-    'Básbryggja 19-21 Naustabryggja 24'
-    'Básbryggja 19-21 Naustabryggja 26'
-    'Dragháls 18-26 18'
-    'Dragháls 18-26 20'
-    'Dragháls 18-26 22'
-    'Dragháls 18-26 24'
-    'Dragháls 18-26 26'
-    'Eirhöfði 8 Breiðhöfði 15'
-    'Gullengi 11*'
-    'Hæðargarður 27 A'
-    'Klapparstígur 1- 7'
-    'Laugavegur 22 -Klapparstígur 33'
-    'Ljósaland 1-25 10'
-    'Ljósaland 1-25 12'
-    'Ljósaland 1-25 14'
-    'Ljósaland 1-25 16'
-    'Ljósaland 1-25 18'
-    'Ljósaland 1-25 2'
-    'Ljósaland 1-25 20'
-    'Ljósaland 1-25 22'
-    'Ljósaland 1-25 24'
-    'Ljósaland 1-25 4'
-    'Ljósaland 1-25 6'
-    'Ljósaland 1-25 8'
-    'Naustabryggja 55- 57'
-    'Skeifan 15, Faxafen 8'
-    'Skrauthólar 5 vegsvæði Vesturlandsvegar'
-    'Skrauthólar 5 vegsvæði hliðarvegar'
-    'Smábýli 12 vegsvæði'
-    'Sundahöfn 1.3, 1.4'
-    'Ártún vegsvæði 2 hliðarvegar'
-    'Ártún vegsvæði 3 hliðarvegar'
-
-    'laugavegur-60a': ['Laugavegur 60A', 'Laugavegur 60a']
-    'eddufell-8': ['Eddufell 8', 'eDDUFELL 8']
-    'eddufell-2': ['Eddufell 2', 'eDDUFELL 2']
-    'eddufell-4': ['Eddufell 4', 'eDDUFELL 4']
-    'eddufell-6': ['Eddufell 6', 'eDDUFELL 6']
-    'skipholt-17a': ['Skipholt 17A', 'Skipholt 17a']
-    'kleppsvegur-bensinstoed': ['Kleppsvegur bensínstöð'
-    'Kleppsvegur Bensínstöð']
-    'vesturgata-5b': ['Vesturgata 5B', 'Vesturgata 5b']
-    'korngardar-13a': ['Korngarðar 13A', 'Korngarðar 13a']
-    'ystibaer-9': ['Ystibær 9', 'ySTIBÆR 9']
-    'laekjargata-14a': ['Lækjargata 14a', 'Lækjargata 14A']
+    Write the address files of a finished scrape and make them the new
+    snapshot. A full scrape replaces the snapshot, an incremental scrape
+    merges its records into the address files it touched and links the
+    rest from the previous snapshot. Safe to run again after a crash.
+    Returns the number of address files written.
     """
-    if " - " in address:
-        # "Fossháls 13-15 - Dragháls 14-16"
-        addresses = address.split(" - ")
-    elif "/" in address:
-        # "Thorvaldsenstræti 2-6/Aðalstræti 11"
-        addresses = address.split("/")
-    else:
-        addresses = [address]
-
-    return_addresses = set()
-    for addr in addresses:
-        addr_strip = addr.strip()
-        match = re.match("(?P<street_name>.*) (?P<start>\d+)-(?P<end>\d+)", addr_strip)
-        if match:
-            groupdict = match.groupdict()
-            street_name = groupdict["street_name"]
-            if " " in street_name:
-                logger.warning(f"Space found in street name: `{street_name}` {href}")
-            start = int(groupdict["start"])
-            end = int(groupdict["end"])
-            while start <= end:
-                return_addresses.add(single_space(f"{street_name} {start}"))
-                start += 2
-        else:
-            return_addresses.add(single_space(addr_strip))
-
-    return list(return_addresses)
-
-
-def convert_image(img) -> tuple[list[str], dict]:
-    href = img["href"]
-
-    meta = img["metadata"]
-    if meta == {}:
-        logger.warning(f"Missing metadata for {href}")
-        return [], {}
-
-    if ADDRESS_KEY in meta:
-        address = meta[ADDRESS_KEY]["value"].strip()
-    else:
-        street_name = meta[STREET_NAME_KEY]["value"].strip()
-        house_number = meta[HOUSE_NUMBER_KEY]["value"].strip()
-        address = f"{street_name} {house_number}"
-    parsed_addresses = parse_address(address, href)
-    if DESCRIPTION_KEY in meta:
-        description = meta[DESCRIPTION_KEY]["value"].strip()
+    scrape_dir = os.path.join(data_dir, scrape_id)
+    addresses_dir = os.path.join(scrape_dir, "addresses")
+    staging_file = os.path.join(scrape_dir, STAGING_FILENAME)
+    snapshot_dir = os.path.join(data_dir, SNAPSHOT_DIRNAME)
+    snapshot_addresses_dir = os.path.join(snapshot_dir, "addresses")
+    if not os.path.exists(staging_file):
+        return 0
+
+    logger.info(f"Materializing {mode} address files for {scrape_id}")
+    store = StagingStore(staging_file)
+    stats = read_stats(snapshot_dir) if mode == MODE_INCREMENTAL else {}
+    updated = 0
+    for address, records in store.iter_addresses():
+        address_file = os.path.join(addresses_dir, f"{address}.json")
+        snapshot_file = os.path.join(snapshot_addresses_dir, f"{address}.json")
+        if mode == MODE_INCREMENTAL and os.path.exists(snapshot_file):
+            records = merge_records(snapshot_file, records)
+        stats[f"{address}.json"] = write_address_file(address_file, records)
+        updated += 1
+    logger.info(f"Address files written: {updated}")
+
+    if mode == MODE_INCREMENTAL:
+        # Files linked from the snapshot keep the stats from the snapshot
+        link_tree(snapshot_addresses_dir, addresses_dir)
+    for filename in os.listdir(addresses_dir):
+        if filename not in stats:
+            stats[filename] = file_stats(os.path.join(addresses_dir, filename))
+    write_stats(scrape_dir, stats)
+
+    new_snapshot_dir = snapshot_dir + ".new"
+    if os.path.exists(new_snapshot_dir):
+        shutil.rmtree(new_snapshot_dir)
+    os.makedirs(os.path.join(new_snapshot_dir, "addresses"))
+    link_tree(addresses_dir, os.path.join(new_snapshot_dir, "addresses"))
+    write_stats(new_snapshot_dir, stats)
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.rename(new_snapshot_dir, snapshot_dir)
+
+    catalog = HrefCatalog(os.path.join(data_dir, CATALOG_FILENAME))
+    if mode == MODE_FULL:
+        catalog.replace(store.iter_hrefs())
     else:
-        description = "[Lýsingu vantar]"
+        catalog.add_many(store.iter_hrefs())
+    catalog.close()
 
-    date = meta[DATE_KEY]["value"].strip() if DATE_KEY in meta else None
-    hash = hashlib.md5(href.encode()).hexdigest()[:7]
+    store.close()
+    os.remove(staging_file)
+    return updated
 
-    data = {
-        "address": address,
-        "date": date,
-        "description": description,
-        "hash": hash,
-        "images": {preview["size"]: preview for preview in img["previews"]},
-        "originalHref": href,
-    }
-    return parsed_addresses, data
 
-
-def process(data_dir: str, status: dict, data: list, url: str) -> None:
+def process(
+    store: StagingStore, catalog: HrefCatalog | None, data: list, url: str
+) -> tuple[list[tuple[str, dict]], list[str]]:
+    """
+    Convert the records of a page that were not seen before in this scrape,
+    or in earlier scrapes when a catalog is given. Returns (rows, hrefs) for
+    `StagingStore.append_many`, the caller commits them together with the
+    status to resume from.
+    """
+    rows = []
+    hrefs = []
     for i, img in enumerate(data):
+        href = img["href"]
+        if store.has_href(href) or (catalog is not None and href in catalog):
+            continue
+        hrefs.append(href)
         try:
             addresses, img_data = convert_image(img)
             for address in addresses:
-                append_data(data_dir, status, address, img_data)
+                rows.append((address, img_data))
         except Exception:
             logger.warning(f"Processing error {i}: {url}")
             continue
+    return rows, hrefs
+
+
+def resume_status(status: dict, store: StagingStore) -> dict:
+    """
+    The staging store's checkpoint is committed with every page while
+    status.json is only written every few pages, so the checkpoint is the
+    later of the two for the same scrape
+    """
+    checkpoint = store.read_checkpoint()
+    if checkpoint is None or checkpoint["scrape_id"] != status["scrape_id"]:
+        return status
+    if checkpoint != status:
+        logger.info("Resuming from the staging checkpoint")
+    return checkpoint
 
 
-def scrape(run_for_seconds: int, data_dir: str, sleep_milliseconds: int):
-    statusfile = os.path.join(data_dir, STATUSFILE)
+def upgrade_status(status: dict) -> dict:
+    """
+    Statuses written before the cursors ran side by side have a single
+    `next_url` for the phase they were in. A scrape that was still
+    descending picks up the ascending cursor from the start.
+    """
+    if "cursors" in status:
+        return status
+    status = status.copy()
+    next_url = status.pop("next_url", None)
+    phase = status["phase"]
+    if phase == PHASE_FETCH_DESCENDING:
+        cursors = start_cursors(status.get("mode", MODE_FULL))
+        cursors[CURSOR_DESCENDING] = next_url
+    elif phase == PHASE_FETCH_ASCENDING:
+        cursors = {CURSOR_ASCENDING: next_url}
+    else:
+        cursors = {}
+    status["cursors"] = cursors
+    if cursors:
+        status["phase"] = PHASE_FETCH
+    return status
+
+
+class Checkpointer:
+    """
+    Makes the staging store durable and writes status.json every `pages`
+    pages or `seconds` seconds, whichever comes first
+    """
+
+    def __init__(self, statusfile: str, pages: int, seconds: float, metrics: Metrics):
+        self._statusfile = statusfile
+        self._pages = pages
+        self._seconds = seconds
+        self._metrics = metrics
+        self._pages_since_sync = 0
+        self._last_sync = time.monotonic()
+
+    def page_committed(self, store: StagingStore, status: dict) -> None:
+        self._pages_since_sync += 1
+        # The scrape's dir and staging store are gone once it has been
+        # materialized, status.json has to say it ended before that
+        if (
+            status["phase"] == PHASE_RESTART
+            or self._pages_since_sync >= self._pages
+            or time.monotonic() - self._last_sync >= self._seconds
+        ):
+            self.sync(store, status)
+
+    def sync(self, store: StagingStore, status: dict) -> None:
+        with self._metrics.phase("checkpoint"):
+            store.sync()
+            write_statusfile(status, self._statusfile)
+        self._pages_since_sync = 0
+        self._last_sync = time.monotonic()
+
+
+def open_scrape(data_dir: str) -> tuple[dict, StagingStore | None, HrefCatalog]:
+    """Status, staging store and catalog to resume from"""
     try:
-        status = read_statusfile(statusfile)
+        status = read_statusfile(os.path.join(data_dir, STATUSFILE))
     except FileNotFoundError:
         status = EMPTY_STATUS.copy()
 
     logger.info(f"Start scrape_id: {status['scrape_id']}")
+    catalog = HrefCatalog(os.path.join(data_dir, CATALOG_FILENAME))
+    store = None
+    if status["scrape_id"] is not None and status["phase"] != PHASE_RESTART:
+        if not os.path.exists(os.path.join(data_dir, status["scrape_id"])):
+            # Moved to last/ by a run that crashed before writing status.json
+            logger.info(f"Scrape dir of {status['scrape_id']} is gone, restarting")
+            status = {**status, "phase": PHASE_RESTART, "cursors": {}}
+    if status["scrape_id"] is not None and status["phase"] != PHASE_RESTART:
+        store = open_staging_store(data_dir, status["scrape_id"])
+        status = resume_status(status, store)
+    return upgrade_status(status), store, catalog
+
+
+def start_next_scrape(
+    data_dir: str,
+    status: dict,
+    store: StagingStore | None,
+    full_scrape_interval_hours: float,
+    metrics: Metrics,
+    on_scrape_finished: Callable[[], None] | None = None,
+) -> tuple[dict, StagingStore]:
+    """
+    Materialize the scrape that just ended, if any, and start the next one.
+    `on_scrape_finished` is called once the finished scrape is in last/.
+    """
+    if store is not None:
+        store.close()
+    mode = status.get("mode", MODE_FULL)
+    last_full_scrape = status.get("last_full_scrape")
+    if status["scrape_id"] is not None:
+        # Already in last/ when a run crashed after the rename
+        if os.path.exists(os.path.join(data_dir, status["scrape_id"])):
+            # Checked up front, materializing removes the staging store
+            check_last_dir_free(data_dir)
+            with metrics.phase("materialize"):
+                written = materialize_addresses(data_dir, status["scrape_id"], mode)
+            metrics.inc("files_written", written)
+            rename_current_scrape_dir(data_dir, status["scrape_id"])
+        if mode == MODE_FULL:
+            last_full_scrape = time.time()
+        if on_scrape_finished is not None:
+            on_scrape_finished()
+    next_mode = choose_mode(data_dir, last_full_scrape, full_scrape_interval_hours)
+    status = init_scrape(data_dir, next_mode, last_full_scrape)
+    store = open_staging_store(data_dir, status["scrape_id"])
+    status["phase"] = PHASE_FETCH
+    status["cursors"] = start_cursors(next_mode)
+    return status, store
+
+
+def choose_cursor(cursors: dict[str, str], previous: str | None) -> str:
+    """Take turns between the cursors that are still walking the listing"""
+    active = [cursor for cursor in CURSOR_ORDER if cursor in cursors]
+    for cursor in active:
+        if cursor != previous:
+            return cursor
+    return active[0]
+
+
+def next_page_url(response_data: dict) -> str:
+    next_path = response_data["paging"]["next"]
+    return f"{BASE_URL}{next_path}"
+
+
+def upcoming_url(status: dict, cursor: str, response_data: dict) -> str | None:
+    """
+    The URL fetched after this page, unless the scrape ends or the cursors
+    meet on it
+    """
+    if len(response_data["data"]) == 0:
+        return None
+    cursors = dict(status["cursors"])
+    cursors[cursor] = next_page_url(response_data)
+    return cursors[choose_cursor(cursors, cursor)]
+
+
+def stage_page(
+    store: StagingStore,
+    catalog: HrefCatalog,
+    status: dict,
+    cursor: str,
+    response_data: dict,
+    unchanged: bool,
+    metrics: Metrics,
+) -> None:
+    """
+    Stage the new records of a page fetched by `cursor` and advance
+    `status` past it. The page's records and the status after it are
+    committed together, so resuming never stages a page twice or skips one.
+
+    The scrape is over when a cursor runs off the end of the listing or
+    reaches hrefs staged by the other cursor, since the two have covered
+    the listing between them.
+    """
+    mode = status.get("mode", MODE_FULL)
+    url = status["cursors"][cursor]
+    cursors = dict(status["cursors"])
+    data = response_data["data"]
+    rows, hrefs = [], []
+    if len(data) == 0:
+        logger.info(f"The {cursor} cursor reached the end of the listing")
+        cursors = {}
+    else:
+        if mode == MODE_INCREMENTAL and unchanged:
+            # Every href on an unchanged page was staged or
+            # cataloged the last time it was fetched
+            new_count = 0
+        else:
+            with metrics.phase("process"):
+                rows, hrefs = process(
+                    store,
+                    catalog if mode == MODE_INCREMENTAL else None,
+                    data,
+                    url,
+                )
+            new_count = len(hrefs)
+            metrics.inc("records_processed", len(data))
+            metrics.inc("records_new", new_count)
+        if mode == MODE_INCREMENTAL and new_count == 0:
+            logger.info("Reached a page of known hrefs, ending scrape")
+            cursors = {}
+        elif store.cursors_of([img["href"] for img in data]) - {cursor, None}:
+            logger.info(f"The {cursor} cursor met the other cursor, ending scrape")
+            cursors = {}
+        else:
+            cursors[cursor] = next_page_url(response_data)
+
+    status["cursors"] = cursors
+    if not cursors:
+        status["phase"] = PHASE_RESTART
+    store.append_many(rows, hrefs, checkpoint=status, cursor=cursor)
+
+
+def record_fetch(metrics: Metrics, page: Page, seconds: float) -> None:
+    metrics.observe("fetch_seconds", seconds)
+    metrics.inc("pages_fetched")
+    if page.unchanged:
+        metrics.inc("pages_unchanged")
+
+
+def scrape(
+    client: HttpClient,
+    pacer: AdaptivePacer,
+    run_for_seconds: int,
+    data_dir: str,
+    full_scrape_interval_hours: float,
+    metrics: Metrics | None = None,
+    checkpoint_pages: int = 20,
+    checkpoint_seconds: float = 30,
+    on_scrape_finished: Callable[[], None] | None = None,
+):
+    if metrics is None:
+        metrics = Metrics("scraper")
+    status, store, catalog = open_scrape(data_dir)
+    checkpointer = Checkpointer(
+        os.path.join(data_dir, STATUSFILE),
+        checkpoint_pages,
+        checkpoint_seconds,
+        metrics,
+    )
 
     start_time = time.time()
     keep_running = True
+    cursor = None
 
     while keep_running:
         phase = status["phase"]
         if phase == PHASE_RESTART:
-            if status["scrape_id"] is not None:
-                rename_current_scrape_dir(data_dir, status["scrape_id"])
-            status = init_scrape(data_dir)
-            next_phase = get_next_phase(phase)
-            status["phase"] = next_phase
-            status["next_url"] = SCRAPE_URLS[next_phase]
+            status, store = start_next_scrape(
+                data_dir,
+                status,
+                store,
+                full_scrape_interval_hours,
+                metrics,
+                on_scrape_finished,
+            )
+            # A new scrape dir and store, status.json has to point at them
+            # before anything is staged there
+            checkpointer.sync(store, status)
         else:
-            url = status["next_url"]
-            response_data = fetch(url)
-            data = response_data["data"]
-            paging = response_data["paging"]
-
-            if len(data) == 0:
-                next_phase = get_next_phase(phase)
-                status["phase"] = next_phase
-                status["next_url"] = SCRAPE_URLS[next_phase]
-            else:
-                process(data_dir, status, data, url)
-                next_path = paging["next"]
-                status["next_url"] = f"{BASE_URL}{next_path}"
+            cursor = choose_cursor(status["cursors"], cursor)
+            fetch_start = time.monotonic()
+            with metrics.phase("fetch"):
+                page = fetch(client, pacer, status["cursors"][cursor])
+            record_fetch(metrics, page, time.monotonic() - fetch_start)
+            response_data = json.loads(page.body)
+            stage_page(
+                store, catalog, status, cursor, response_data, page.unchanged, metrics
+            )
+            checkpointer.page_committed(store, status)
+
+        remaining_seconds = run_for_seconds - (time.time() - start_time)
+        keep_running = remaining_seconds > 0
+        if keep_running and phase != PHASE_RESTART:
+            with metrics.phase("sleep"):
+                time.sleep(min(pacer.delay, remaining_seconds))
+
+    if store is not None:
+        checkpointer.sync(store, status)
+        store.close()
+    catalog.close()
+    logger.info("End")
+
+
+async def fetch_after(
+    client: AsyncHttpClient, pacer: AdaptivePacer, url: str, delay: float
+) -> tuple[Page, float]:
+    await asyncio.sleep(delay)
+    logger.info(f"Fetching {url}")
+    fetch_start = time.monotonic()
+    page = await client.get_page(url, pacer)
+    return page, time.monotonic() - fetch_start
+
+
+def discard(task: asyncio.Task) -> None:
+    """Cancel a prefetch that is not needed, and drop its outcome if it ended"""
+    if not task.cancel() and not task.cancelled():
+        task.exception()
+
+
+async def scrape_pipelined(
+    client: AsyncHttpClient,
+    pacer: AdaptivePacer,
+    run_for_seconds: int,
+    data_dir: str,
+    full_scrape_interval_hours: float,
+    metrics: Metrics | None = None,
+    checkpoint_pages: int = 20,
+    checkpoint_seconds: float = 30,
+    on_scrape_finished: Callable[[], None] | None = None,
+):
+    """
+    `scrape` with the fetch of the next page overlapping the staging of the
+    current one. Every request still waits `pacer.delay` after the previous
+    response, as in `scrape`, also when there is no prefetch to use, but
+    staging and checkpoints run in a worker thread in the meantime instead
+    of adding to the gap.
+    """
+    if metrics is None:
+        metrics = Metrics("scraper")
+    # The SQLite connections are opened and only ever used on this one thread
+    executor = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_running_loop()
+
+    def run_in_executor(function, *args):
+        return loop.run_in_executor(executor, function, *args)
+
+    status, store, catalog = await run_in_executor(open_scrape, data_dir)
+    checkpointer = Checkpointer(
+        os.path.join(data_dir, STATUSFILE),
+        checkpoint_pages,
+        checkpoint_seconds,
+        metrics,
+    )
+
+    start_time = time.time()
+    keep_running = True
+    cursor = None
+    prefetch_url = None
+    prefetch = None
+    last_response = None
 
-        write_statusfile(status, statusfile)
-        time.sleep(sleep_milliseconds / 1000)
-        keep_running = (time.time() - start_time) < run_for_seconds
+    def pacing_delay() -> float:
+        """What is left of `pacer.delay` since the last response"""
+        if last_response is None:
+            return 0
+        return max(0, pacer.delay - (time.monotonic() - last_response))
 
+    try:
+        while keep_running:
+            phase = status["phase"]
+            if phase == PHASE_RESTART:
+                status, store = await run_in_executor(
+                    start_next_scrape,
+                    data_dir,
+                    status,
+                    store,
+                    full_scrape_interval_hours,
+                    metrics,
+                    on_scrape_finished,
+                )
+                await run_in_executor(checkpointer.sync, store, status)
+            else:
+                cursor = choose_cursor(status["cursors"], cursor)
+                url = status["cursors"][cursor]
+                if prefetch is None or prefetch_url != url:
+                    if prefetch is not None:
+                        # Its request may have been answered already
+                        discard(prefetch)
+                        last_response = time.monotonic()
+                    prefetch = asyncio.create_task(
+                        fetch_after(client, pacer, url, pacing_delay())
+                    )
+                with metrics.phase("fetch"):
+                    page, fetch_seconds = await prefetch
+                last_response = time.monotonic()
+                prefetch = None
+                record_fetch(metrics, page, fetch_seconds)
+                response_data = json.loads(page.body)
+
+                # Start on the next page before staging this one. When the
+                # scrape ends on this page the request is wasted, once per
+                # scrape.
+                remaining_seconds = run_for_seconds - (time.time() - start_time)
+                prefetch_url = upcoming_url(status, cursor, response_data)
+                if prefetch_url and remaining_seconds > pacer.delay:
+                    prefetch = asyncio.create_task(
+                        fetch_after(client, pacer, prefetch_url, pacing_delay())
+                    )
+
+                await run_in_executor(
+                    stage_page,
+                    store,
+                    catalog,
+                    status,
+                    cursor,
+                    response_data,
+                    page.unchanged,
+                    metrics,
+                )
+                await run_in_executor(checkpointer.page_committed, store, status)
+
+            remaining_seconds = run_for_seconds - (time.time() - start_time)
+            # Without a prefetch the next request first waits out the pacing
+            # delay, not worth starting when the run ends before it is over
+            keep_running = remaining_seconds > 0 and (
+                prefetch is not None or remaining_seconds > pacing_delay()
+            )
+
+        if store is not None:
+            await run_in_executor(checkpointer.sync, store, status)
+    finally:
+        if prefetch is not None:
+            discard(prefetch)
+        if store is not None:
+            await run_in_executor(store.close)
+        await run_in_executor(catalog.close)
+        executor.shutdown()
     logger.info("End")
 
 
+def make_cache(config: Config) -> ResponseCache | None:
+    if config.cache_max_megabytes <= 0:
+        return None
+    return ResponseCache(
+        config.cache_dir or os.path.join(config.data_dir, "http-cache"),
+        config.cache_max_megabytes * 1024 * 1024,
+    )
+
+
+def make_pacer(config: Config) -> AdaptivePacer:
+    return AdaptivePacer(
+        initial_delay=config.sleep_milliseconds / 1000,
+        min_delay=config.min_sleep_milliseconds / 1000,
+        max_delay=config.max_sleep_milliseconds / 1000,
+        target_latency=config.target_latency_milliseconds / 1000,
+        max_retries=config.max_retries,
+    )
+
+
+def make_client(config: Config, cache: ResponseCache | None) -> HttpClient:
+    return HttpClient(
+        connect_timeout=config.connect_timeout_seconds,
+        read_timeout=config.read_timeout_seconds,
+        cache=cache,
+    )
+
+
+def make_async_client(
+    config: Config, cache: ResponseCache | None
+) -> AsyncHttpClient:
+    """Has to be called from a coroutine running in the event loop"""
+    return AsyncHttpClient(
+        connect_timeout=config.connect_timeout_seconds,
+        read_timeout=config.read_timeout_seconds,
+        cache=cache,
+    )
+
+
+def run(
+    config: Config,
+    cache: ResponseCache | None,
+    pacer: AdaptivePacer,
+    metrics: Metrics,
+) -> None:
+    client = make_client(config, cache)
+    try:
+        scrape(
+            client,
+            pacer,
+            config.run_for_seconds,
+            config.data_dir,
+            config.full_scrape_interval_hours,
+            metrics,
+            config.checkpoint_pages,
+            config.checkpoint_seconds,
+        )
+    finally:
+        export_client_stats(client, metrics)
+        client.close()
+
+
+async def run_pipelined(
+    config: Config,
+    cache: ResponseCache | None,
+    pacer: AdaptivePacer,
+    metrics: Metrics,
+) -> None:
+    client = make_async_client(config, cache)
+    try:
+        await scrape_pipelined(
+            client,
+            pacer,
+            config.run_for_seconds,
+            config.data_dir,
+            config.full_scrape_interval_hours,
+            metrics,
+            config.checkpoint_pages,
+            config.checkpoint_seconds,
+        )
+    finally:
+        export_client_stats(client, metrics)
+        await client.close()
+
+
+def export_client_stats(client: HttpClient | AsyncHttpClient, metrics: Metrics) -> None:
+    client.log_stats()
+    stats = client.stats()
+    metrics.set("http_requests", stats.requests)
+    metrics.set("http_connections", stats.connections)
+    metrics.set("http_not_modified", stats.not_modified)
+    metrics.set("http_retries", stats.retries)
+    metrics.set("bytes_received", stats.bytes_received)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("configfile")
@@ -313,11 +883,26 @@ def main():
     if config.log_to_stderr.lower() == "true":
         logging.getLogger().addHandler(logging.StreamHandler())
 
-    scrape(
-        config.run_for_seconds,
-        config.data_dir,
-        config.sleep_milliseconds,
-    )
+    try:
+        # Skip this run while the previous one, or daemon.py, is still going
+        with single_instance(os.path.join(config.data_dir, LOCKFILE)):
+            cache = make_cache(config)
+            pacer = make_pacer(config)
+            engine = choose_engine(config.engine)
+            metrics = Metrics("scraper")
+            metrics_dir = config.metrics_dir or os.path.join(
+                config.data_dir, "metrics"
+            )
+            try:
+                with profiling(config.profile, metrics_dir, "scraper"):
+                    if engine == ENGINE_ASYNC:
+                        asyncio.run(run_pipelined(config, cache, pacer, metrics))
+                    else:
+                        run(config, cache, pacer, metrics)
+            finally:
+                metrics.write(metrics_dir)
+    except AlreadyRunning as e:
+        logger.info(f"Not starting, {e}")
 
 
 if __name__ == "__main__":
@@ -6,19 +6,33 @@ from collections import namedtuple
 import configparser
 import json
 import os
-import csv
+import hashlib
 import shutil
+import threading
+import time
 import boto3
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterator
 import traceback
 
+from address_parsing import normalize
+from address_stats import read_stats, write_stats
+from artifacts import CONTENT_TYPE, choose_encoding, compact_dump, encode_body
+from coord_store import CoordStore
+from metrics import Metrics, profiling
+import preview_mirror
+from preview_mirror import PreviewMirror
+from single_instance import AlreadyRunning, single_instance
+import search_index
+import tile_index
+
 logger = logging.getLogger(__name__)
 
-DATE_KEY = "30"
-STREET_NAME_KEY = "203"
-HOUSE_NUMBER_KEY = "204"
-ADDRESS_KEY = "210"
-DESCRIPTION_KEY = "214"
+# Address files and indexes keep their names when they change, shards don't
+CACHE_CONTROL = "public, max-age=300"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+LOCKFILE = "uploader.lock"
 
 
 Config = namedtuple(
@@ -28,6 +42,19 @@ Config = namedtuple(
         aws_config_file
         logfile
         log_to_stderr
+        upload_workers
+        upload_attempts
+        content_encoding
+        cache_control
+        immutable_cache_control
+        metrics_dir
+        profile
+        mirror_previews
+        mirror_url_prefix
+        mirror_sizes
+        mirror_workers
+        mirror_requests_per_second
+        mirror_run_for_seconds
     """,
 )
 
@@ -50,21 +77,53 @@ class Paths:
         self.addresses_dir = self.last_dir / "addresses"
         self.uploaded_dir = self.data_dir / "uploaded"
         self.uploaded_addresses_dir = self.uploaded_dir / "addresses"
+        self.manifest_path = self.data_dir / "upload-manifest.json"
+        self.mirror_index_path = self.data_dir / preview_mirror.INDEX_FILENAME
+        self.published_search_manifest_path = (
+            self.data_dir / search_index.MANIFEST_FILENAME
+        )
+        self.published_tile_manifest_path = self.data_dir / tile_index.MANIFEST_FILENAME
 
         self.stadfangaskra_path = self.data_dir / "Stadfangaskra.csv"
         self.address_index_path = self.last_dir / "addresses.json"
         self.coord_bounds_path = self.last_dir / "coord-bounds.json"
+        self.search_dir = self.last_dir / "search"
+        self.search_manifest_path = self.last_dir / search_index.MANIFEST_FILENAME
+        self.tile_dir = self.last_dir / "tiles"
+        self.tile_manifest_path = self.last_dir / tile_index.MANIFEST_FILENAME
 
 
 def read_configs(configfile: str) -> tuple[Config, AwsConfig]:
     parser = configparser.ConfigParser()
     parser.read(configfile)
+    mirror_sizes = parser.get("upload", "mirror_sizes", fallback="400,2400")
     config = Config(
         logfile=parser.get("upload", "logfile"),
         log_to_stderr=parser.get("upload", "log_to_stderr", fallback="false"),
         data_dir=parser.get("upload", "data_dir"),
         aws_config_file=parser.get("upload", "aws_config_file"),
+        upload_workers=parser.getint("upload", "upload_workers", fallback=16),
+        upload_attempts=parser.getint("upload", "upload_attempts", fallback=3),
+        content_encoding=parser.get("upload", "content_encoding", fallback="gzip"),
+        cache_control=parser.get("upload", "cache_control", fallback=CACHE_CONTROL),
+        immutable_cache_control=parser.get(
+            "upload", "immutable_cache_control", fallback=IMMUTABLE_CACHE_CONTROL
+        ),
+        metrics_dir=parser.get("upload", "metrics_dir", fallback=None),
+        profile=parser.getboolean("upload", "profile", fallback=False),
+        mirror_previews=parser.getboolean("upload", "mirror_previews", fallback=False),
+        mirror_url_prefix=parser.get("upload", "mirror_url_prefix", fallback=None),
+        mirror_sizes=[size.strip() for size in mirror_sizes.split(",")],
+        mirror_workers=parser.getint("upload", "mirror_workers", fallback=4),
+        mirror_requests_per_second=parser.getfloat(
+            "upload", "mirror_requests_per_second", fallback=2
+        ),
+        mirror_run_for_seconds=parser.getfloat(
+            "upload", "mirror_run_for_seconds", fallback=600
+        ),
     )
+    if config.mirror_previews and not config.mirror_url_prefix:
+        raise ValueError("mirror_previews needs mirror_url_prefix")
 
     aws_parser = configparser.ConfigParser()
     aws_parser.read(config.aws_config_file)
@@ -79,39 +138,210 @@ def read_configs(configfile: str) -> tuple[Config, AwsConfig]:
     return config, aws_config
 
 
-def normalize(address):
-    return (
-        address.lower()
-        .replace("á", "a")
-        .replace("é", "e")
-        .replace("í", "i")
-        .replace("ó", "o")
-        .replace("ú", "u")
-        .replace("ý", "y")
-        .replace("þ", "t")
-        .replace("æ", "ae")
-        .replace("ö", "o")
-        .replace("ð", "d")
-    )
+class UploadError(Exception):
+    pass
+
+
+class TransferEngine:
+    """
+    Uploads and deletes objects from a bounded pool of worker threads.
+    Every request is retried with exponential backoff up to `attempts`
+    times, and throughput and latency are counted for the run summary.
+
+    Uploaded files are compressed with `content_encoding` and stored with
+    matching Content-Encoding, Content-Type and Cache-Control metadata.
+    """
+
+    # The most keys S3 accepts in a single DeleteObjects request
+    MAX_DELETE_KEYS = 1000
+
+    def __init__(
+        self,
+        s3_client,
+        bucket_name: str,
+        workers: int,
+        attempts: int,
+        content_encoding: str = "gzip",
+        metrics: Metrics | None = None,
+    ):
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._attempts = attempts
+        self._metrics = metrics if metrics is not None else Metrics("uploader")
+        self._content_encoding = choose_encoding(content_encoding)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._uploads = 0
+        self._deletes = 0
+        self._retries = 0
+        self._bytes = 0
+        self._bytes_encoded = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def put(self, file_path: Path, bucket_key: str, cache_control: str) -> Future:
+        """Returns a future that resolves to the ETag of the uploaded object"""
+        return self._executor.submit(self._put, file_path, bucket_key, cache_control)
+
+    def put_bytes(
+        self, body: bytes, bucket_key: str, cache_control: str, content_type: str
+    ) -> Future:
+        """Uploads `body` as it is, for content that is already compressed"""
+        metadata = {"ContentType": content_type, "CacheControl": cache_control}
+        return self._executor.submit(
+            self._put_object, bucket_key, body, body, metadata
+        )
+
+    def _put(self, file_path: Path, bucket_key: str, cache_control: str) -> str:
+        body = file_path.read_bytes()
+        encoded = encode_body(body, self._content_encoding)
+        metadata = {"ContentType": CONTENT_TYPE, "CacheControl": cache_control}
+        if self._content_encoding != "identity":
+            metadata["ContentEncoding"] = self._content_encoding
+        return self._put_object(bucket_key, body, encoded, metadata)
+
+    def _put_object(
+        self, bucket_key: str, body: bytes, encoded: bytes, metadata: dict
+    ) -> str:
+        attempt = 1
+        while True:
+            start = time.monotonic()
+            try:
+                response = self._s3_client.put_object(
+                    Bucket=self._bucket_name, Key=bucket_key, Body=encoded, **metadata
+                )
+                break
+            except Exception as e:
+                if attempt >= self._attempts:
+                    raise
+                logger.warning(f"Uploading {bucket_key} failed ({e}), retrying")
+                with self._lock:
+                    self._retries += 1
+                time.sleep(2**attempt)
+                attempt += 1
+
+        latency = time.monotonic() - start
+        with self._lock:
+            self._uploads += 1
+            self._bytes += len(body)
+            self._bytes_encoded += len(encoded)
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+        self._metrics.observe("upload_seconds", latency)
+        return response["ETag"]
+
+    def delete(self, bucket_keys: list[str]) -> list[Future]:
+        """
+        Delete keys in batches of up to MAX_DELETE_KEYS. Each future
+        resolves to the keys of its batch that could not be deleted.
+        """
+        return [
+            self._executor.submit(
+                self._delete, bucket_keys[i : i + self.MAX_DELETE_KEYS]
+            )
+            for i in range(0, len(bucket_keys), self.MAX_DELETE_KEYS)
+        ]
+
+    def _delete(self, bucket_keys: list[str]) -> list[str]:
+        remaining = bucket_keys
+        attempt = 1
+        while True:
+            try:
+                response = self._s3_client.delete_objects(
+                    Bucket=self._bucket_name,
+                    Delete={
+                        "Objects": [{"Key": key} for key in remaining],
+                        "Quiet": True,
+                    },
+                )
+                errors = response.get("Errors", [])
+                for error in errors:
+                    logger.warning(
+                        f"Deleting {error['Key']} failed: "
+                        f"{error.get('Code')} {error.get('Message')}"
+                    )
+                failed = [error["Key"] for error in errors]
+            except Exception as e:
+                logger.warning(f"Deleting {len(remaining)} keys failed ({e})")
+                failed = remaining
+
+            with self._lock:
+                self._deletes += len(remaining) - len(failed)
+            if not failed or attempt >= self._attempts:
+                return failed
+            with self._lock:
+                self._retries += 1
+            time.sleep(2**attempt)
+            remaining = failed
+            attempt += 1
+
+    def list_keys(self, prefix: str) -> Iterator[str]:
+        paginator = self._s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"]
+
+    def export_stats(self) -> None:
+        self._metrics.set("uploads", self._uploads)
+        self._metrics.set("deletes", self._deletes)
+        self._metrics.set("retries", self._retries)
+        self._metrics.set("bytes_uploaded", self._bytes)
+        self._metrics.set("bytes_uploaded_encoded", self._bytes_encoded)
+
+    def log_stats(self) -> None:
+        elapsed = time.monotonic() - self._started
+        average = self._latency_total / self._uploads if self._uploads else 0
+        logger.info(
+            f"Uploads: {self._uploads}, deletes: {self._deletes}, "
+            f"retries: {self._retries}, "
+            f"bytes: {self._bytes} ({self._bytes_encoded} {self._content_encoding}), "
+            f"{self._uploads / elapsed:.1f} uploads/s, "
+            f"{self._bytes_encoded / elapsed / 1024:.1f} KiB/s, "
+            f"latency avg: {average:.3f}s max: {self._latency_max:.3f}s"
+        )
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
 
 
 class Uploader:
     ADDRESS_FILES_KEY_PREIFX = "addresses"
     ADDRESS_INDEX_FILENAME = "addresses.json"
     COORD_BOUNDS_FILENAME = "coord-bounds.json"
-
-    def __init__(self, s3_client, bucket_name: str, bucket_path_prefix: str):
+    SEARCH_KEY_PREFIX = "search"
+    TILE_KEY_PREFIX = "tiles"
+
+    def __init__(
+        self,
+        s3_client,
+        bucket_name: str,
+        bucket_path_prefix: str,
+        workers: int = 16,
+        attempts: int = 3,
+        content_encoding: str = "gzip",
+        cache_control: str = CACHE_CONTROL,
+        immutable_cache_control: str = IMMUTABLE_CACHE_CONTROL,
+        metrics: Metrics | None = None,
+    ):
         self._s3_client = s3_client
         self._bucket_name = bucket_name
         self._bucket_path_prefix = bucket_path_prefix
         self._uploaded_address_files = []
+        self._cache_control = cache_control
+        self._immutable_cache_control = immutable_cache_control
+        self._engine = TransferEngine(
+            s3_client, bucket_name, workers, attempts, content_encoding, metrics
+        )
 
-    def upload_address_file(self, file_path: Path, filename: str) -> None:
+    def upload_address_file(self, file_path: Path, filename: str) -> Future:
+        """Queues the upload, the returned future resolves to the ETag"""
         bucket_key = os.path.join(
             self._bucket_path_prefix, self.ADDRESS_FILES_KEY_PREIFX, filename
         )
         self._uploaded_address_files.append(bucket_key)
-        self._upload(file_path, bucket_key)
+        logger.info(f"Uploading {file_path} to {bucket_key}")
+        return self._engine.put(file_path, bucket_key, self._cache_control)
 
     def upload_address_index_file(self, file_path: Path) -> None:
         bucket_key = os.path.join(self._bucket_path_prefix, self.ADDRESS_INDEX_FILENAME)
@@ -121,49 +351,86 @@ class Uploader:
         bucket_key = os.path.join(self._bucket_path_prefix, self.COORD_BOUNDS_FILENAME)
         self._upload(file_path, bucket_key)
 
-    def _upload(self, file_path: Path, bucket_key: str) -> None:
+    def upload_shard(self, key_prefix: str, file_path: Path) -> Future:
+        bucket_key = os.path.join(self._bucket_path_prefix, key_prefix, file_path.name)
         logger.info(f"Uploading {file_path} to {bucket_key}")
-        self._s3_client.upload_file(file_path, self._bucket_name, bucket_key)
+        # Shards are named by their content hash, so they never change
+        return self._engine.put(file_path, bucket_key, self._immutable_cache_control)
+
+    def upload_preview(self, key: str, body: bytes, content_type: str) -> Future:
+        bucket_key = os.path.join(self._bucket_path_prefix, key)
+        # Previews are keyed by drawing and size, and never change
+        return self._engine.put_bytes(
+            body, bucket_key, self._immutable_cache_control, content_type
+        )
 
-    def remove_old_uploads(self, paths: Paths) -> None:
-        address_files = set([address.name for address in paths.addresses_dir.iterdir()])
-        if paths.uploaded_addresses_dir.exists():
-            uploaded_address_files = set(
-                [
-                    uploaded_address.name
-                    for uploaded_address in paths.uploaded_addresses_dir.iterdir()
-                ]
+    def upload_shard_manifest_file(self, file_path: Path) -> None:
+        bucket_key = os.path.join(self._bucket_path_prefix, file_path.name)
+        self._upload(file_path, bucket_key)
+
+    def remove_old_shards(self, key_prefix: str, filenames: set[str]) -> None:
+        """
+        Delete every shard under `key_prefix` that is not one of `filenames`.
+        The bucket listing is the source of truth, as in `remove_old_uploads`,
+        so shards a failed delete left behind are removed on a later run.
+        """
+        shard_prefix = os.path.join(self._bucket_path_prefix, key_prefix, "")
+        keys = [
+            key
+            for key in self._engine.list_keys(shard_prefix)
+            if key[len(shard_prefix) :] not in filenames
+        ]
+        logger.info(f"Removing {len(keys)} old files from {key_prefix}")
+        failed = set()
+        for future in self._engine.delete(keys):
+            failed.update(future.result())
+        if failed:
+            raise UploadError(
+                f"{len(failed)} old files in {key_prefix} failed to delete"
             )
-        else:
-            uploaded_address_files = set()
 
-        remove = uploaded_address_files - address_files
+    def _upload(self, file_path: Path, bucket_key: str) -> str:
+        logger.info(f"Uploading {file_path} to {bucket_key}")
+        return self._engine.put(file_path, bucket_key, self._cache_control).result()
+
+    def close(self) -> None:
+        self._engine.shutdown()
+        self._engine.log_stats()
+        self._engine.export_stats()
+
+    def remove_old_uploads(self, paths: Paths, manifest: dict) -> None:
+        """
+        Delete every address file in the bucket that is not in the current
+        scrape. The bucket listing is the source of truth, so files left
+        behind by earlier failed runs are cleaned up as well.
+        """
+        address_files = set([address.name for address in paths.addresses_dir.iterdir()])
+        key_prefix = os.path.join(
+            self._bucket_path_prefix, self.ADDRESS_FILES_KEY_PREIFX, ""
+        )
+        remove = [
+            key
+            for key in self._engine.list_keys(key_prefix)
+            if key[len(key_prefix) :] not in address_files
+        ]
         logger.info(f"Remove count: {len(remove)}")
 
-        for filename in remove:
-            key = os.path.join(
-                self._bucket_path_prefix, self.ADDRESS_FILES_KEY_PREIFX, filename
-            )
-            logger.info(f"Removing {key}")
-            self._s3_client.delete_object(Bucket=self._bucket_name, Key=key)
-
+        failed = set()
+        for future in self._engine.delete(remove):
+            failed.update(future.result())
 
-def get_coords(stadfangaskra_path: Path) -> dict:
-    coords = {}
-    with stadfangaskra_path.open() as f:
-        stadfangaskra = csv.DictReader(f)
-        for row in stadfangaskra:
-            if row["POSTNR"] != "" and int(row["POSTNR"]) < 200:
-                address = f"{row['HEITI_NF']} {row['HUSNR']}"
-                lat = float(row["N_HNIT_WGS84"])
-                lng = float(row["E_HNIT_WGS84"])
-                coords[address] = [lat, lng]
+        for filename in set(manifest) - address_files:
+            if key_prefix + filename not in failed:
+                del manifest[filename]
 
-    return coords
+        if failed:
+            raise UploadError(f"{len(failed)} old address files failed to delete")
 
 
-def construct_address_index_and_coord_bounds(paths: Paths) -> tuple[list, dict]:
-    coords = get_coords(paths.stadfangaskra_path)
+def construct_address_index_and_coord_bounds(
+    paths: Paths, stats: dict
+) -> tuple[list, dict]:
+    coords = CoordStore(paths.stadfangaskra_path)
 
     address_index = []
     lat_min = 1000
@@ -171,25 +438,24 @@ def construct_address_index_and_coord_bounds(paths: Paths) -> tuple[list, dict]:
     lng_min = 1000
     lng_max = -1000
 
-    for address_path in paths.addresses_dir.iterdir():
-        with address_path.open() as f:
-            drawings = json.load(f)
-
-        address = address_path.name[:-5]  # strip .json
+    for filename, address_stats in stats.items():
+        address = filename[:-5]  # strip .json
         address_info = {
             "address": address,
             "normalized": normalize(address),
-            "count": len(drawings),
+            "count": address_stats["count"],
         }
-        if address in coords:
-            address_info["coords"] = coords[address]
-            lat, lng = coords[address]
+        address_coords = coords.get(address)
+        if address_coords is not None:
+            address_info["coords"] = address_coords
+            lat, lng = address_coords
             lat_min = min(lat_min, lat)
             lat_max = max(lat_max, lat)
             lng_min = min(lng_min, lng)
             lng_max = max(lng_max, lng)
 
         address_index.append(address_info)
+    coords.close()
 
     coord_bounds = {
         "lat_min": lat_min,
@@ -201,36 +467,230 @@ def construct_address_index_and_coord_bounds(paths: Paths) -> tuple[list, dict]:
     return address_index, coord_bounds
 
 
-def upload_changed_addresses(paths: Paths, uploader: Uploader) -> None:
-    for address_path in paths.addresses_dir.iterdir():
-        uploaded_address_path = paths.uploaded_addresses_dir / address_path.name
-        if not uploaded_address_path.exists() or (
-            address_path.read_bytes() != uploaded_address_path.read_bytes()
-        ):
-            uploader.upload_address_file(address_path, address_path.name)
+def file_hash(file_path: Path) -> str:
+    return hashlib.md5(file_path.read_bytes()).hexdigest()
 
 
-def process(paths: Paths, uploader: Uploader) -> None:
+def read_manifest(paths: Paths) -> dict:
+    """
+    The manifest maps each uploaded address file to the hash, size and ETag
+    of the uploaded version. Before it existed the uploader kept a copy of
+    every uploaded file, so a missing manifest is built from that copy.
+    """
+    if paths.manifest_path.exists():
+        with paths.manifest_path.open() as f:
+            return json.load(f)
+
+    manifest = {}
+    if paths.uploaded_addresses_dir.exists():
+        logger.info(f"Building upload manifest from {paths.uploaded_addresses_dir}")
+        for address_path in paths.uploaded_addresses_dir.iterdir():
+            manifest[address_path.name] = {
+                "hash": file_hash(address_path),
+                "size": address_path.stat().st_size,
+                "etag": None,
+            }
+    return manifest
+
+
+def write_manifest(paths: Paths, manifest: dict) -> None:
+    tmp_path = paths.manifest_path.with_suffix(".tmp")
+    with tmp_path.open("w") as f:
+        json.dump(manifest, f)
+    tmp_path.replace(paths.manifest_path)
+
+
+def upload_changed_addresses(
+    paths: Paths, uploader: Uploader, manifest: dict, stats: dict
+) -> None:
+    pending = []
+    for filename, address_stats in stats.items():
+        address_path = paths.addresses_dir / filename
+        address_hash = address_stats["hash"]
+        entry = manifest.get(address_path.name)
+        if entry is None or entry["hash"] != address_hash:
+            future = uploader.upload_address_file(address_path, address_path.name)
+            pending.append((address_path, address_hash, future))
+
+    failed = 0
+    for address_path, address_hash, future in pending:
+        try:
+            etag = future.result()
+        except Exception as e:
+            logger.error(f"Uploading {address_path} failed: {e}")
+            failed += 1
+            continue
+        manifest[address_path.name] = {
+            "hash": address_hash,
+            "size": address_path.stat().st_size,
+            "etag": etag,
+        }
+
+    if failed > 0:
+        raise UploadError(f"{failed} address files failed to upload")
+
+
+def publish_sharded_index(
+    uploader: Uploader,
+    key_prefix: str,
+    shard_dir: Path,
+    manifest_path: Path,
+    published_manifest_path: Path,
+    shard_files: Callable[[dict], set[str]],
+) -> None:
+    """
+    Upload the shards that are not in the bucket yet, then the manifest
+    pointing at them, and only then remove the shards the manifest does not
+    point at.
+    """
+    with manifest_path.open() as f:
+        manifest = json.load(f)
+    published_files = set()
+    if published_manifest_path.exists():
+        with published_manifest_path.open() as f:
+            published_files = shard_files(json.load(f))
+
+    new_files = shard_files(manifest) - published_files
+    logger.info(f"Changed files in {key_prefix}: {len(new_files)}")
+    futures = [
+        uploader.upload_shard(key_prefix, shard_dir / filename)
+        for filename in sorted(new_files)
+    ]
+    for future in futures:
+        future.result()
+
+    uploader.upload_shard_manifest_file(manifest_path)
+    shutil.copyfile(manifest_path, published_manifest_path)
+
+    uploader.remove_old_shards(key_prefix, shard_files(manifest))
+
+
+def process(
+    paths: Paths,
+    uploader: Uploader,
+    metrics: Metrics | None = None,
+    mirror: PreviewMirror | None = None,
+) -> None:
+    if metrics is None:
+        metrics = Metrics("uploader")
     if not paths.last_dir.exists():
         logger.info(f"No last dir found at {paths.last_dir}, exiting")
         return
 
-    address_index, coord_bounds = construct_address_index_and_coord_bounds(paths)
-    with paths.address_index_path.open("w") as f:
-        json.dump(address_index, f)
+    # Counts and hashes were recorded when the scrape wrote the address files
+    stats = read_stats(str(paths.last_dir))
+    if mirror is not None:
+        with metrics.phase("mirror"):
+            mirrored = mirror.mirror(str(paths.addresses_dir), uploader.upload_preview)
+            rewritten = mirror.rewrite(str(paths.addresses_dir), stats)
+            write_stats(str(paths.last_dir), stats)
+        metrics.set("previews_mirrored", mirrored)
+        metrics.set("address_files_rewritten", rewritten)
+
+    with metrics.phase("index"):
+        address_index, coord_bounds = construct_address_index_and_coord_bounds(
+            paths, stats
+        )
+        with paths.address_index_path.open("w", encoding="utf-8") as f:
+            compact_dump(address_index, f)
 
-    with paths.coord_bounds_path.open("w") as f:
-        json.dump(coord_bounds, f)
+        with paths.coord_bounds_path.open("w", encoding="utf-8") as f:
+            compact_dump(coord_bounds, f)
 
-    upload_changed_addresses(paths, uploader)
-    uploader.upload_address_index_file(paths.address_index_path)
-    uploader.upload_coord_bounds_file(paths.coord_bounds_path)
+        search_manifest = search_index.write_shards(
+            str(paths.search_dir), address_index
+        )
+        with paths.search_manifest_path.open("w", encoding="utf-8") as f:
+            compact_dump(search_manifest, f)
 
-    uploader.remove_old_uploads(paths)
+        tile_manifest = tile_index.write_tiles(str(paths.tile_dir), address_index)
+        with paths.tile_manifest_path.open("w", encoding="utf-8") as f:
+            compact_dump(tile_manifest, f)
+    metrics.set("addresses", len(address_index))
+
+    manifest = read_manifest(paths)
+    try:
+        with metrics.phase("addresses"):
+            # Raises if any address file failed, so the index is only published
+            # once every file it points to is in the bucket
+            upload_changed_addresses(paths, uploader, manifest, stats)
+            uploader.upload_address_index_file(paths.address_index_path)
+            uploader.upload_coord_bounds_file(paths.coord_bounds_path)
+        with metrics.phase("search"):
+            publish_sharded_index(
+                uploader,
+                Uploader.SEARCH_KEY_PREFIX,
+                paths.search_dir,
+                paths.search_manifest_path,
+                paths.published_search_manifest_path,
+                search_index.shard_files,
+            )
+        with metrics.phase("tiles"):
+            publish_sharded_index(
+                uploader,
+                Uploader.TILE_KEY_PREFIX,
+                paths.tile_dir,
+                paths.tile_manifest_path,
+                paths.published_tile_manifest_path,
+                tile_index.tile_files,
+            )
+
+        with metrics.phase("remove"):
+            uploader.remove_old_uploads(paths, manifest)
+    finally:
+        # Keep track of what made it to the bucket even if the run failed
+        write_manifest(paths, manifest)
 
     if paths.uploaded_dir.exists():
         shutil.rmtree(paths.uploaded_dir)
-    paths.last_dir.rename(paths.uploaded_dir)
+    shutil.rmtree(paths.last_dir)
+
+
+def make_s3_client(aws_config: AwsConfig):
+    return boto3.client(
+        service_name="s3",
+        endpoint_url=aws_config.aws_endpoint_url,
+        aws_access_key_id=aws_config.aws_access_key_id,
+        aws_secret_access_key=aws_config.aws_secret_access_key,
+    )
+
+
+def run(config: Config, aws_config: AwsConfig, s3_client) -> None:
+    """Upload last/, if there is one, with a client that may be reused"""
+    paths = Paths(config.data_dir)
+    metrics = Metrics("uploader")
+    metrics_dir = config.metrics_dir or os.path.join(config.data_dir, "metrics")
+
+    uploader = Uploader(
+        s3_client,
+        aws_config.bucket_name,
+        aws_config.bucket_path_prefix,
+        workers=config.upload_workers,
+        attempts=config.upload_attempts,
+        content_encoding=config.content_encoding,
+        cache_control=config.cache_control,
+        immutable_cache_control=config.immutable_cache_control,
+        metrics=metrics,
+    )
+    mirror = None
+    if config.mirror_previews:
+        mirror = PreviewMirror(
+            str(paths.mirror_index_path),
+            config.mirror_url_prefix,
+            config.mirror_sizes,
+            workers=config.mirror_workers,
+            requests_per_second=config.mirror_requests_per_second,
+            run_for_seconds=config.mirror_run_for_seconds,
+        )
+
+    try:
+        with profiling(config.profile, metrics_dir, "uploader"):
+            process(paths, uploader, metrics, mirror)
+    finally:
+        if mirror is not None:
+            mirror.close()
+        uploader.close()
+        metrics.write(metrics_dir)
 
 
 def main():
@@ -247,20 +707,12 @@ def main():
     if config.log_to_stderr.lower() == "true":
         logging.getLogger().addHandler(logging.StreamHandler())
 
-    s3_client = boto3.client(
-        service_name="s3",
-        endpoint_url=aws_config.aws_endpoint_url,
-        aws_access_key_id=aws_config.aws_access_key_id,
-        aws_secret_access_key=aws_config.aws_secret_access_key,
-    )
-
-    paths = Paths(config.data_dir)
-
-    uploader = Uploader(
-        s3_client, aws_config.bucket_name, aws_config.bucket_path_prefix
-    )
-
-    process(paths, uploader)
+    try:
+        # Skip this run while the previous one, or daemon.py, is still going
+        with single_instance(os.path.join(config.data_dir, LOCKFILE)):
+            run(config, aws_config, make_s3_client(aws_config))
+    except AlreadyRunning as e:
+        logger.info(f"Not starting, {e}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Long running alternative to starting cron-scraper.py and cron-uploader.py
+from cron.
+
+    python daemon.py scrape-test-config.ini
+
+Reads the same [scrape] and [upload] sections as the cron scripts, plus an
+optional [daemon] section. Scrapes run back to back, `run_for_seconds` at a
+time with `interval_seconds` in between, on HTTP and S3 clients that stay
+open for the life of the daemon. As soon as a scrape cycle has been moved to
+last/ it is uploaded, before the scraper starts on the next cycle.
+
+The daemon holds the same lockfiles as the cron scripts, so cron runs left
+in place skip while it is running. SIGTERM stops it after the current
+scrape run; the scrape resumes from its checkpoint on the next start.
+"""
+
+import argparse
+import asyncio
+import configparser
+import importlib.util
+import logging
+import os
+import signal
+import threading
+import traceback
+from collections import namedtuple
+from contextlib import ExitStack
+
+from metrics import Metrics, profiling
+from single_instance import AlreadyRunning, single_instance
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(name: str):
+    """Import one of the hyphenated cron scripts as a module"""
+    path = os.path.join(SCRAPER_DIR, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+cron_scraper = load_script("cron-scraper")
+cron_uploader = load_script("cron-uploader")
+
+Config = namedtuple(
+    "Config",
+    """
+        logfile
+        log_to_stderr
+        interval_seconds
+    """,
+)
+
+
+def read_config(configfile: str) -> Config:
+    parser = configparser.ConfigParser()
+    parser.read(configfile)
+    config = Config(
+        logfile=parser.get(
+            "daemon", "logfile", fallback=parser.get("scrape", "logfile")
+        ),
+        log_to_stderr=parser.get("daemon", "log_to_stderr", fallback="false"),
+        interval_seconds=parser.getfloat("daemon", "interval_seconds", fallback=0),
+    )
+    return config
+
+
+class UploadJob:
+    """Uploads last/ with one S3 client for the life of the daemon"""
+
+    def __init__(self, config, aws_config):
+        self._config = config
+        self._aws_config = aws_config
+        self._s3_client = cron_uploader.make_s3_client(aws_config)
+        self._paths = cron_uploader.Paths(config.data_dir)
+
+    def run(self) -> None:
+        if not self._paths.last_dir.exists():
+            return
+        try:
+            cron_uploader.run(self._config, self._aws_config, self._s3_client)
+        except Exception as e:
+            # last/ stays in place and the upload is retried on the next tick
+            stacktrace = traceback.format_exc()
+            logger.error(f"Upload failed: {e}\n{stacktrace}")
+
+
+class ScrapeJob:
+    """
+    Runs the scraper `run_for_seconds` at a time on an HTTP client that is
+    kept open between runs. With the async engine the client lives on an
+    event loop of its own that is reused for every run.
+    """
+
+    def __init__(self, config, on_scrape_finished):
+        self._config = config
+        self._on_scrape_finished = on_scrape_finished
+        self._engine = cron_scraper.choose_engine(config.engine)
+        self._pacer = cron_scraper.make_pacer(config)
+        cache = cron_scraper.make_cache(config)
+        self._loop = None
+        if self._engine == cron_scraper.ENGINE_ASYNC:
+            self._loop = asyncio.new_event_loop()
+            self._client = self._loop.run_until_complete(self._open_async(cache))
+        else:
+            self._client = cron_scraper.make_client(config, cache)
+
+    async def _open_async(self, cache):
+        return cron_scraper.make_async_client(self._config, cache)
+
+    def run(self) -> None:
+        config = self._config
+        metrics = Metrics("scraper")
+        metrics_dir = config.metrics_dir or os.path.join(config.data_dir, "metrics")
+        args = (
+            self._client,
+            self._pacer,
+            config.run_for_seconds,
+            config.data_dir,
+            config.full_scrape_interval_hours,
+            metrics,
+            config.checkpoint_pages,
+            config.checkpoint_seconds,
+            self._on_scrape_finished,
+        )
+        try:
+            with profiling(config.profile, metrics_dir, "scraper"):
+                if self._loop is not None:
+                    self._loop.run_until_complete(
+                        cron_scraper.scrape_pipelined(*args)
+                    )
+                else:
+                    cron_scraper.scrape(*args)
+        except Exception as e:
+            stacktrace = traceback.format_exc()
+            logger.error(f"Scrape failed: {e}\n{stacktrace}")
+        finally:
+            # HTTP stats add up over the life of the client, not per run
+            cron_scraper.export_client_stats(self._client, metrics)
+            metrics.write(metrics_dir)
+
+    def close(self) -> None:
+        if self._loop is not None:
+            self._loop.run_until_complete(self._client.close())
+            self._loop.close()
+        else:
+            self._client.close()
+
+
+def run(configfile: str, config: Config, stop: threading.Event) -> None:
+    scrape_config = cron_scraper.read_config(configfile)
+    upload_config, aws_config = cron_uploader.read_configs(configfile)
+    with ExitStack() as stack:
+        stack.enter_context(
+            single_instance(
+                os.path.join(scrape_config.data_dir, cron_scraper.LOCKFILE)
+            )
+        )
+        stack.enter_context(
+            single_instance(
+                os.path.join(upload_config.data_dir, cron_uploader.LOCKFILE)
+            )
+        )
+        upload_job = UploadJob(upload_config, aws_config)
+        scrape_job = ScrapeJob(scrape_config, upload_job.run)
+        stack.callback(scrape_job.close)
+        logger.info("Daemon started")
+        while not stop.is_set():
+            # Picks up a scrape that finished while the daemon was down, or
+            # whose upload failed
+            upload_job.run()
+            scrape_job.run()
+            stop.wait(config.interval_seconds)
+    logger.info("Daemon stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configfile")
+    args = parser.parse_args()
+
+    config = read_config(args.configfile)
+    logging.basicConfig(
+        format="%(asctime)s [" + str(os.getpid()) + "] [%(levelname)s] %(message)s",
+        filename=config.logfile,
+        level=logging.INFO,
+    )
+    if config.log_to_stderr.lower() == "true":
+        logging.getLogger().addHandler(logging.StreamHandler())
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        run(args.configfile, config, stop)
+    except AlreadyRunning as e:
+        logger.info(f"Not starting, {e}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error(f"Error: {e}\n{stacktrace}")
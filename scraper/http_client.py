@@ -0,0 +1,189 @@
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pacing import AdaptivePacer, TokenBucket, is_retryable, parse_retry_after
+from response_cache import ResponseCache, content_hash
+
+logger = logging.getLogger(__name__)
+
+HEADERS = {
+    "Accept": "application/vnd.fotoware.assetlist+json, */*; q=0.01",
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+CONNECT_TIMEOUT_SECONDS = 10
+READ_TIMEOUT_SECONDS = 60
+POOL_MAXSIZE = 10
+
+ClientStats = namedtuple(
+    "ClientStats", "requests connections reused bytes_received not_modified retries"
+)
+Page = namedtuple("Page", "body content_hash unchanged")
+
+
+class HttpClient:
+    """
+    Keep-alive HTTP client shared by the scrapers.
+
+    All requests go through one pooled `requests.Session`, so consecutive
+    pages from skjalasafn.reykjavik.is reuse the same TLS connection. With a
+    `ResponseCache`, `get_page` sends conditional requests and serves 304
+    responses from the cache.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+        read_timeout: float = READ_TIMEOUT_SECONDS,
+        pool_maxsize: int = POOL_MAXSIZE,
+        cache: ResponseCache | None = None,
+    ):
+        self._timeout = (connect_timeout, read_timeout)
+        self._session = requests.Session()
+        self._session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._adapter = adapter
+        self._cache = cache
+        self._requests = 0
+        self._bytes_received = 0
+        self._not_modified = 0
+        self._retries = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        url: str,
+        pacer: AdaptivePacer | None = None,
+        headers: dict | None = None,
+        bucket: TokenBucket | None = None,
+    ) -> requests.Response:
+        """
+        Without a pacer a failed request raises straight away. With one,
+        retryable failures are retried with the pacer's backoff until its
+        retry budget runs out. With a bucket shared between threads, every
+        attempt, retries included, waits for a token, and the bucket follows
+        the pacer's rate.
+        """
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = self._get(url, headers)
+            except requests.RequestException as e:
+                response = e.response
+                status = response.status_code if response is not None else None
+                if pacer is None or not is_retryable(status):
+                    raise
+                attempt += 1
+                with self._lock:
+                    self._retries += 1
+                pacer.record_failure()
+                self._follow_pacer(bucket, pacer)
+                retry_after = (
+                    parse_retry_after(response.headers.get("Retry-After"))
+                    if response is not None
+                    else None
+                )
+                wait = pacer.backoff(attempt, retry_after)
+                logger.warning(f"Fetching {url} failed ({e}), retry in {wait:.1f}s")
+                time.sleep(wait)
+                continue
+
+            if pacer is not None:
+                pacer.record_success(time.monotonic() - start)
+                self._follow_pacer(bucket, pacer)
+            return response
+
+    def _follow_pacer(self, bucket: TokenBucket | None, pacer: AdaptivePacer) -> None:
+        # The pacer slows down on errors and slow responses, and speeds back
+        # up to the configured rate while the server is healthy
+        if bucket is not None:
+            bucket.set_rate(1 / pacer.delay)
+
+    def get_page(
+        self,
+        url: str,
+        pacer: AdaptivePacer | None = None,
+        bucket: TokenBucket | None = None,
+    ) -> Page:
+        """
+        Fetch a page body. `unchanged` is true when the body is the same as
+        the one cached from the previous fetch of the URL.
+        """
+        if self._cache is None:
+            body = self.get(url, pacer, bucket=bucket).content
+            return Page(body, content_hash(body), False)
+
+        entry = self._cache.lookup(url)
+        headers = {}
+        if entry is not None and entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+
+        response = self.get(url, pacer, headers, bucket)
+        if response.status_code == 304:
+            body = self._cache.read_body(url)
+            if body is not None:
+                return Page(body, entry.content_hash, True)
+            # Evicted since the lookup, fetch it again without validators
+            response = self.get(url, pacer, bucket=bucket)
+
+        body = response.content
+        body_hash = self._cache.store(
+            url,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            body,
+        )
+        return Page(
+            body, body_hash, entry is not None and entry.content_hash == body_hash
+        )
+
+    def get_json(self, url: str, pacer: AdaptivePacer | None = None):
+        return json.loads(self.get_page(url, pacer).body)
+
+    def _get(self, url: str, headers: dict | None = None) -> requests.Response:
+        response = self._session.get(url, headers=headers, timeout=self._timeout)
+        with self._lock:
+            self._requests += 1
+            self._bytes_received += len(response.content)
+            if response.status_code == 304:
+                self._not_modified += 1
+        response.raise_for_status()
+        return response
+
+    def stats(self) -> ClientStats:
+        pools = self._adapter.poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        return ClientStats(
+            requests=self._requests,
+            connections=connections,
+            reused=self._requests - connections,
+            bytes_received=self._bytes_received,
+            not_modified=self._not_modified,
+            retries=self._retries,
+        )
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.info(
+            f"HTTP requests: {stats.requests}, connections: {stats.connections}, "
+            f"reused: {stats.reused}, bytes received: {stats.bytes_received}, "
+            f"not modified: {stats.not_modified}, retries: {stats.retries}"
+        )
+
+    def close(self) -> None:
+        self._session.close()
+        if self._cache is not None:
+            self._cache.close()
@@ -0,0 +1,186 @@
+"""
+Run metrics for the cron scripts.
+
+A `Metrics` instance collects counters, gauges, histograms and time spent
+per phase during one run. At the end of the run it is written out as a
+Prometheus textfile, for node_exporter's textfile collector, and as a JSON
+summary of the run.
+
+`profiling` optionally wraps a run in cProfile and tracemalloc and leaves
+the profile and the top allocations next to the metrics.
+"""
+
+import bisect
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TRACEMALLOC_TOP = 50
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """(le, count) pairs the way Prometheus expects them"""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((f"{bound:g}", total))
+        result.append(("+Inf", self.count))
+        return result
+
+
+class Metrics:
+    def __init__(self, job: str):
+        self.job = job
+        self.started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+            self._histograms[name].observe(value)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + elapsed
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "job": self.job,
+                "started": datetime.fromtimestamp(self.started).isoformat(),
+                "duration_seconds": time.time() - self.started,
+                "phase_seconds": dict(self._phases),
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {
+                    name: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": dict(histogram.cumulative()),
+                    }
+                    for name, histogram in self._histograms.items()
+                },
+            }
+
+    def prometheus_text(self) -> str:
+        summary = self.summary()
+        prefix = f"fotoweb_{self.job}"
+        lines = [
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            f"{prefix}_last_run_timestamp_seconds {self.started}",
+            f"# TYPE {prefix}_duration_seconds gauge",
+            f"{prefix}_duration_seconds {summary['duration_seconds']}",
+            f"# TYPE {prefix}_phase_seconds gauge",
+        ]
+        for name, seconds in sorted(summary["phase_seconds"].items()):
+            lines.append(f'{prefix}_phase_seconds{{phase="{name}"}} {seconds}')
+        # Counters are per run, so they are exported as gauges
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        for name, value in sorted(summary["gauges"].items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            for name, histogram in histograms:
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for le, count in histogram.cumulative():
+                    lines.append(f'{prefix}_{name}_bucket{{le="{le}"}} {count}')
+                lines.append(f"{prefix}_{name}_sum {histogram.sum}")
+                lines.append(f"{prefix}_{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_dir: str) -> None:
+        """Write <job>.prom and <job>-last-run.json to `metrics_dir`"""
+        os.makedirs(metrics_dir, exist_ok=True)
+        # Written to a temporary file and renamed, so the textfile collector
+        # never reads a partial file
+        write_atomic(
+            os.path.join(metrics_dir, f"{self.job}.prom"), self.prometheus_text()
+        )
+        write_atomic(
+            os.path.join(metrics_dir, f"{self.job}-last-run.json"),
+            json.dumps(self.summary(), indent=2),
+        )
+
+
+def write_atomic(path: str, content: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def profiling(enabled: bool, output_dir: str, job: str) -> Iterator[None]:
+    """
+    Run the body under cProfile and tracemalloc when enabled. Leaves
+    <job>-<timestamp>.prof, for pstats or snakeviz, and
+    <job>-<timestamp>-memory.txt with the top allocations.
+    """
+    if not enabled:
+        yield
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, f"{job}-{datetime.now():%Y%m%d-%H%M%S}")
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(base + ".prof")
+        with open(base + "-memory.txt", "w") as f:
+            f.write(f"current: {current} bytes, peak: {peak} bytes\n\n")
+            for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                f.write(f"{stat}\n")
+        logger.info(f"Wrote profile to {base}.prof")
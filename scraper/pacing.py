@@ -0,0 +1,126 @@
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, `acquire` blocks until a request may be sent.
+
+    Callers reserve a token even when the bucket is empty and sleep until it
+    has been refilled, so waiting threads are served in order and the overall
+    rate never exceeds `rate` requests per second.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._capacity, self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._rate = rate
+
+
+class RetryBudgetExceeded(Exception):
+    pass
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def is_retryable(status: int | None) -> bool:
+    """Connection errors (no status), 429 and 5xx are worth retrying"""
+    return status is None or status == 429 or status >= 500
+
+
+class AdaptivePacer:
+    """
+    Decides how long to wait between requests and between retries.
+
+    The delay shrinks while responses are fast and the recent error rate is
+    low, and grows when the server slows down or starts failing. Retries back
+    off exponentially with full jitter, honor Retry-After up to `max_delay`,
+    and give up after `max_retries` attempts of a single request.
+    """
+
+    def __init__(
+        self,
+        initial_delay: float,
+        min_delay: float,
+        max_delay: float,
+        target_latency: float,
+        max_retries: int,
+        backoff_base: float = 1.0,
+        window: int = 20,
+        max_error_rate: float = 0.1,
+    ):
+        self._delay = initial_delay
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._target_latency = target_latency
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._max_error_rate = max_error_rate
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def delay(self) -> float:
+        return self._delay
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self._outcomes.append(True)
+            errors = self._outcomes.count(False) / len(self._outcomes)
+            if latency <= self._target_latency and errors <= self._max_error_rate:
+                self._delay = max(self._min_delay, self._delay * 0.9)
+            elif latency > self._target_latency:
+                self._delay = min(self._max_delay, self._delay * 1.5)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._outcomes.append(False)
+            self._delay = min(self._max_delay, max(self._min_delay, self._delay * 2))
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        """
+        Seconds to wait before retry number `attempt` (starting at 1).
+        Raises RetryBudgetExceeded when the retry budget is used up.
+        """
+        if attempt > self._max_retries:
+            raise RetryBudgetExceeded(f"Giving up after {self._max_retries} retries")
+        ceiling = min(self._max_delay, self._backoff_base * 2**attempt)
+        wait = random.uniform(0, ceiling)
+        if retry_after is not None:
+            # A Retry-After of hours would use up the run sleeping
+            wait = max(wait, min(retry_after, self._max_delay))
+        return wait
@@ -0,0 +1,250 @@
+"""
+Mirror of the archive's preview images in our own bucket.
+
+Each preview size of a drawing is downloaded once, keyed by the drawing's
+`hash`, and uploaded to previews/<hash>/<size><ext>. What has been mirrored
+is kept in a SQLite index between runs, so a run that runs out of time or
+fails picks up where the last one stopped. The address files are then
+rewritten so `images[size].href` points at the mirror, as an absolute URL.
+Previews that are not mirrored yet keep their archive path.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+from urllib.parse import urlparse
+
+from address_stats import STATS_FILENAME, content_stats
+from artifacts import compact_dumps
+from http_client import HttpClient
+from pacing import AdaptivePacer, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "previews"
+INDEX_FILENAME = "preview-mirror.sqlite3"
+ORIGIN_URL = "https://skjalasafn.reykjavik.is"
+DEFAULT_CONTENT_TYPE = "image/jpeg"
+MAX_RETRIES = 5
+MAX_DELAY_SECONDS = 60
+TARGET_LATENCY_SECONDS = 2
+
+
+class MirrorIndex:
+    """(hash, size) -> (originalHref, key) of every mirrored preview"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS previews (
+                hash TEXT NOT NULL,
+                size TEXT NOT NULL,
+                original_href TEXT NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (hash, size)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def load(self) -> dict[tuple[str, str], tuple[str, str]]:
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT hash, size, original_href, key FROM previews"
+            )
+            return {(row[0], row[1]): (row[2], row[3]) for row in cursor}
+
+    def add(self, hash: str, size: str, original_href: str, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO previews VALUES (?, ?, ?, ?)",
+                (hash, size, original_href, key),
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def preview_key(hash: str, size: str, href: str) -> str:
+    extension = os.path.splitext(urlparse(href).path)[1] or ".jpg"
+    return f"{KEY_PREFIX}/{hash}/{size}{extension}"
+
+
+def pending_previews(
+    addresses_dir: str, sizes: list[str], mirrored: dict
+) -> tuple[list[tuple[str, str, str, str]], set[str]]:
+    """
+    (hash, size, originalHref, href) of the previews to mirror, and the
+    address files that still point at the archive for one of `sizes`. The
+    hash is only seven hex digits, a preview whose hash is already taken by
+    another drawing is left on the archive.
+    """
+    pending = {}
+    filenames = set()
+    for filename in sorted(os.listdir(addresses_dir)):
+        with open(os.path.join(addresses_dir, filename), encoding="utf-8") as f:
+            records = json.load(f)
+        for img_data in records:
+            for size in sizes:
+                preview = img_data.get("images", {}).get(size)
+                if preview is None or not preview["href"].startswith("/"):
+                    continue
+                filenames.add(filename)
+                key = (img_data.get("hash"), size)
+                if key in mirrored or key in pending:
+                    continue
+                pending[key] = (*key, img_data["originalHref"], preview["href"])
+    return list(pending.values()), filenames
+
+
+def rewrite_hrefs(records: list[dict], mirrored: dict, url_prefix: str) -> bool:
+    """Point mirrored previews at the mirror, returns whether anything changed"""
+    changed = False
+    for img_data in records:
+        for size, preview in img_data.get("images", {}).items():
+            entry = mirrored.get((img_data.get("hash"), size))
+            if entry is None or entry[0] != img_data["originalHref"]:
+                continue
+            href = f"{url_prefix}/{entry[1]}"
+            if preview["href"] != href:
+                preview["href"] = href
+                changed = True
+    return changed
+
+
+class PreviewMirror:
+    """
+    Downloads previews from the archive with `workers` threads, no faster
+    than `requests_per_second`, and uploads each one as soon as it arrives.
+    """
+
+    def __init__(
+        self,
+        index_path: str,
+        url_prefix: str,
+        sizes: list[str],
+        workers: int = 4,
+        requests_per_second: float = 2,
+        run_for_seconds: float = 600,
+    ):
+        self._index = MirrorIndex(index_path)
+        self._url_prefix = url_prefix.rstrip("/")
+        self._sizes = sizes
+        self._workers = workers
+        self._run_for_seconds = run_for_seconds
+        # Address files the last `mirror` found pointing at the archive
+        self._to_rewrite = set()
+        self._client = HttpClient(pool_maxsize=workers)
+        self._bucket = TokenBucket(requests_per_second)
+        self._pacer = AdaptivePacer(
+            initial_delay=1 / requests_per_second,
+            min_delay=1 / requests_per_second,
+            max_delay=MAX_DELAY_SECONDS,
+            target_latency=TARGET_LATENCY_SECONDS,
+            max_retries=MAX_RETRIES,
+        )
+
+    def mirror(
+        self, addresses_dir: str, upload: Callable[[str, bytes, str], Future]
+    ) -> int:
+        """
+        Mirror the previews of the address files that are not mirrored yet,
+        until they are all done or `run_for_seconds` is up. `upload` is
+        called with (key, body, content type). Returns the number mirrored.
+        """
+        pending, self._to_rewrite = pending_previews(
+            addresses_dir, self._sizes, self._index.load()
+        )
+        logger.info(f"{len(pending)} previews to mirror")
+        deadline = time.monotonic() + self._run_for_seconds
+        mirrored = 0
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            # Submitted in batches, so the run stops close to its deadline
+            # without queueing every preview up front
+            batch_size = self._workers * 16
+            for i in range(0, len(pending), batch_size):
+                if time.monotonic() >= deadline:
+                    logger.info("Out of time, the rest is mirrored on the next run")
+                    break
+                futures = [
+                    executor.submit(self._mirror_one, *preview, upload)
+                    for preview in pending[i : i + batch_size]
+                ]
+                for preview, future in zip(pending[i : i + batch_size], futures):
+                    try:
+                        future.result()
+                        mirrored += 1
+                    except Exception as e:
+                        logger.warning(f"Mirroring {preview[3]} failed: {e}")
+                        failed += 1
+        logger.info(f"Mirrored {mirrored} previews, {failed} failed")
+        return mirrored
+
+    def _mirror_one(
+        self,
+        hash: str,
+        size: str,
+        original_href: str,
+        href: str,
+        upload: Callable[[str, bytes, str], Future],
+    ) -> None:
+        response = self._client.get(
+            ORIGIN_URL + href, self._pacer, bucket=self._bucket
+        )
+        content_type = response.headers.get("Content-Type", DEFAULT_CONTENT_TYPE)
+        key = preview_key(hash, size, href)
+        upload(key, response.content, content_type).result()
+        self._index.add(hash, size, original_href, key)
+
+    def rewrite(self, addresses_dir: str, stats: dict) -> int:
+        """
+        Rewrite the address files `mirror` found pointing at the archive to
+        use the mirror, and update their `stats` to match. Returns the
+        number of files changed.
+        """
+        mirrored = self._index.load()
+        stats_file = os.path.join(os.path.dirname(addresses_dir), STATS_FILENAME)
+        stats_mtime = (
+            os.stat(stats_file).st_mtime_ns if os.path.exists(stats_file) else 0
+        )
+        changed = 0
+        for filename in os.listdir(addresses_dir):
+            address_file = os.path.join(addresses_dir, filename)
+            content = None
+            if filename in self._to_rewrite:
+                with open(address_file, "rb") as f:
+                    content = f.read()
+                records = json.loads(content)
+                if rewrite_hrefs(records, mirrored, self._url_prefix):
+                    content = compact_dumps(records).encode()
+                    tmp_file = address_file + ".tmp"
+                    with open(tmp_file, "wb") as f:
+                        f.write(content)
+                    os.replace(tmp_file, address_file)
+                    stats[filename] = content_stats(content, records)
+                    changed += 1
+                    continue
+            # An interrupted run may have rewritten the file without getting
+            # to save its stats, only then is it newer than the stats file
+            if os.stat(address_file).st_mtime_ns <= stats_mtime:
+                continue
+            if content is None:
+                with open(address_file, "rb") as f:
+                    content = f.read()
+            if stats.get(filename, {}).get("hash") != hashlib.md5(content).hexdigest():
+                stats[filename] = content_stats(content, json.loads(content))
+        return changed
+
+    def close(self) -> None:
+        self._client.log_stats()
+        self._client.close()
+        self._index.close()
@@ -0,0 +1,169 @@
+"""
+Compressed archive of raw assetlist pages.
+
+Pages are stored as compact JSON lines in gzip compressed segments of
+PAGES_PER_SEGMENT pages each. Every page is its own gzip member, so a
+segment is still a valid .jsonl.gz file while a single page can be read by
+seeking to its offset. The index is an append-only JSON lines file of
+page -> (segment, offset, length), where the last entry for a page wins.
+
+Run as a script to convert a directory of legacy per-page .json files:
+
+    python raw_archive.py scrape-2023-10-01
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from typing import Iterator
+
+PAGES_PER_SEGMENT = 256
+INDEX_FILENAME = "index.jsonl"
+SEGMENT_TEMPLATE = "segment-{segment:04d}.jsonl.gz"
+
+
+def is_archive(archive_dir: str) -> bool:
+    return os.path.exists(os.path.join(archive_dir, INDEX_FILENAME))
+
+
+class ArchiveWriter:
+    def __init__(self, archive_dir: str, pages_per_segment: int = PAGES_PER_SEGMENT):
+        os.makedirs(archive_dir, exist_ok=True)
+        self._archive_dir = archive_dir
+        self._pages_per_segment = pages_per_segment
+        self._lock = threading.Lock()
+
+    def write_page(self, page: int, data) -> None:
+        line = json.dumps(data, separators=(",", ":"), ensure_ascii=False) + "\n"
+        member = gzip.compress(line.encode())
+        segment = page // self._pages_per_segment
+        segment_path = os.path.join(
+            self._archive_dir, SEGMENT_TEMPLATE.format(segment=segment)
+        )
+        with self._lock:
+            with open(segment_path, "ab") as f:
+                offset = f.tell()
+                f.write(member)
+            entry = {
+                "page": page,
+                "segment": segment,
+                "offset": offset,
+                "length": len(member),
+            }
+            with open(os.path.join(self._archive_dir, INDEX_FILENAME), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+class ArchiveReader:
+    def __init__(self, archive_dir: str):
+        self._archive_dir = archive_dir
+        self._index = {}
+        with open(os.path.join(archive_dir, INDEX_FILENAME)) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # Partially written entry from an interrupted scrape
+                    break
+                entry = json.loads(line)
+                self._index[entry["page"]] = (
+                    entry["segment"],
+                    entry["offset"],
+                    entry["length"],
+                )
+
+    def pages(self) -> list[int]:
+        return sorted(self._index)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._archive_dir, SEGMENT_TEMPLATE.format(segment=segment))
+
+    def read_page(self, page: int):
+        segment, offset, length = self._index[page]
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return json.loads(gzip.decompress(f.read(length)))
+
+    def segments(self) -> dict[int, list[tuple[int, int, int]]]:
+        """Map each segment to its (page, offset, length) entries in page order"""
+        segments = defaultdict(list)
+        for page, (segment, offset, length) in self._index.items():
+            segments[segment].append((page, offset, length))
+        return {segment: sorted(segments[segment]) for segment in sorted(segments)}
+
+    def iter_pages(self) -> Iterator[tuple[int, dict]]:
+        """Yield (page, data) in page order, opening each segment once"""
+        for segment, entries in self.segments().items():
+            yield from read_segment(self._archive_dir, segment, entries)
+
+
+def read_segment(
+    archive_dir: str, segment: int, entries: list[tuple[int, int, int]]
+) -> Iterator[tuple[int, dict]]:
+    segment_path = os.path.join(archive_dir, SEGMENT_TEMPLATE.format(segment=segment))
+    with open(segment_path, "rb") as f:
+        for page, offset, length in entries:
+            f.seek(offset)
+            yield page, json.loads(gzip.decompress(f.read(length)))
+
+
+def scrape_units(scrape_dir: str) -> list[tuple]:
+    """
+    Split a scrape into independently readable units: archive segments,
+    followed by legacy per-page .json files for pages not in the archive.
+    Units are plain tuples so they can be handed to worker processes.
+    """
+    units = []
+    archived = set()
+    if is_archive(scrape_dir):
+        reader = ArchiveReader(scrape_dir)
+        archived = set(reader.pages())
+        for segment, entries in reader.segments().items():
+            units.append(("segment", segment, entries))
+
+    for filename in legacy_page_files(scrape_dir):
+        if int(filename[:-5]) not in archived:
+            units.append(("file", filename))
+    return units
+
+
+def read_unit(scrape_dir: str, unit: tuple) -> Iterator[dict]:
+    if unit[0] == "segment":
+        _, segment, entries = unit
+        for _, data in read_segment(scrape_dir, segment, entries):
+            yield data
+    else:
+        with open(os.path.join(scrape_dir, unit[1])) as f:
+            yield json.load(f)
+
+
+def iter_scrape_pages(scrape_dir: str) -> Iterator[dict]:
+    for unit in scrape_units(scrape_dir):
+        yield from read_unit(scrape_dir, unit)
+
+
+def legacy_page_files(scrape_dir: str) -> list[str]:
+    return sorted(
+        filename
+        for filename in os.listdir(scrape_dir)
+        if filename.endswith(".json") and filename[:-5].isdigit()
+    )
+
+
+def convert(scrape_dir: str) -> None:
+    writer = ArchiveWriter(scrape_dir)
+    filenames = legacy_page_files(scrape_dir)
+    for filename in filenames:
+        with open(os.path.join(scrape_dir, filename)) as f:
+            writer.write_page(int(filename[:-5]), json.load(f))
+    for filename in filenames:
+        os.remove(os.path.join(scrape_dir, filename))
+    print(f"Converted {len(filenames)} pages in {scrape_dir}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Error: missing scrape dir", file=sys.stderr)
+        sys.exit(1)
+    convert(sys.argv[1])
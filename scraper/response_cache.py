@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+CacheEntry = namedtuple("CacheEntry", "etag last_modified content_hash")
+
+
+def content_hash(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of HTTP response bodies keyed by URL.
+
+    Bodies are stored gzip compressed next to a SQLite index that keeps the
+    validators (ETag, Last-Modified) needed for conditional requests. The
+    least recently used entries are evicted once the compressed bodies take
+    up more than `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self._bodies_dir = os.path.join(cache_dir, "bodies")
+        os.makedirs(self._bodies_dir, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite3"), check_same_thread=False
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+
+    def _body_path(self, url: str) -> str:
+        return os.path.join(self._bodies_dir, hashlib.sha256(url.encode()).hexdigest())
+
+    def lookup(self, url: str) -> CacheEntry | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, content_hash FROM entries WHERE url = ?",
+                (url,),
+            ).fetchone()
+        return CacheEntry(*row) if row is not None else None
+
+    def read_body(self, url: str) -> bytes | None:
+        with self._lock:
+            try:
+                with open(self._body_path(url), "rb") as f:
+                    body = gzip.decompress(f.read())
+            except FileNotFoundError:
+                return None
+            with self._conn:
+                self._conn.execute(
+                    "UPDATE entries SET accessed = ? WHERE url = ?", (time.time(), url)
+                )
+        return body
+
+    def store(
+        self, url: str, etag: str | None, last_modified: str | None, body: bytes
+    ) -> str:
+        body_hash = content_hash(body)
+        compressed = gzip.compress(body)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+            if row is not None:
+                self._total_bytes -= row[0]
+
+            tmp_path = self._body_path(url) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp_path, self._body_path(url))
+
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, etag, last_modified, body_hash, len(compressed), time.time()),
+                )
+            self._total_bytes += len(compressed)
+            self._evict()
+        return body_hash
+
+    def _evict(self) -> None:
+        if self._total_bytes <= self._max_bytes:
+            return
+
+        # Evict down to 90% so the next few stores don't each trigger a scan
+        target_bytes = self._max_bytes * 0.9
+        evicted = 0
+        rows = self._conn.execute(
+            "SELECT url, size FROM entries ORDER BY accessed ASC"
+        ).fetchall()
+        with self._conn:
+            for url, size in rows:
+                if self._total_bytes <= target_bytes:
+                    break
+                try:
+                    os.remove(self._body_path(url))
+                except FileNotFoundError:
+                    pass
+                self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self._total_bytes -= size
+                evicted += 1
+        logger.info(f"Evicted {evicted} cached responses")
+
+    def close(self) -> None:
+        self._conn.close()
@@ -1,59 +1,146 @@
+import argparse
+import configparser
 import os
 import json
-import requests
 import datetime
-import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from http_client import HttpClient
+from pacing import AdaptivePacer, TokenBucket
+from raw_archive import ArchiveWriter
+from response_cache import ResponseCache
 
 
 CURRENT_SCRAPE_FILE = "current-scrape.json"
 URL = "https://skjalasafn.reykjavik.is/fotoweb/archives/5001-A%C3%B0aluppdr%C3%A6ttir/;p={index}"
-HEADERS = {"Accept": "application/vnd.fotoware.assetlist+json, */*; q=0.01"}
 FIRST_PAGE = 0
 LAST_PAGE = 7892
-FILENAME_TEMPLATE = "{id}/{index:04d}.json"
 LOGLINE = "{index}/{last_page}"
 SLEEP_SECONDS = 3
+MAX_SLEEP_SECONDS = 60
+TARGET_LATENCY_SECONDS = 2
+MAX_RETRIES = 8
+WORKERS = 1
+CACHE_MAX_MEGABYTES = 512
+
+Config = namedtuple(
+    "Config",
+    "workers requests_per_second target_latency max_retries cache_dir cache_max_megabytes",
+)
+
+
+def read_config(configfile: str | None) -> Config:
+    parser = configparser.ConfigParser()
+    if configfile is not None:
+        parser.read(configfile)
+    return Config(
+        workers=parser.getint("archive", "workers", fallback=WORKERS),
+        requests_per_second=parser.getfloat(
+            "archive", "requests_per_second", fallback=1 / SLEEP_SECONDS
+        ),
+        target_latency=parser.getfloat(
+            "archive", "target_latency_seconds", fallback=TARGET_LATENCY_SECONDS
+        ),
+        max_retries=parser.getint("archive", "max_retries", fallback=MAX_RETRIES),
+        cache_dir=parser.get("archive", "cache_dir", fallback=None),
+        cache_max_megabytes=parser.getint(
+            "archive", "cache_max_megabytes", fallback=CACHE_MAX_MEGABYTES
+        ),
+    )
 
 
-def get_current_scrape_info():
+def to_ranges(pages: set[int]) -> list[list[int]]:
+    ranges = []
+    for page in sorted(pages):
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ranges
+
+
+def get_current_scrape_info() -> tuple[str, set[int]]:
     try:
         with open(CURRENT_SCRAPE_FILE, "r") as f:
             info = json.load(f)
-            return info["id"], info["index"]
     except (FileNotFoundError, json.JSONDecodeError):
         id = "scrape-" + str(datetime.date.today())
-        index = FIRST_PAGE - 1
-        return id, index
+        return id, set()
+
+    if "completed" in info:
+        completed = set()
+        for start, end in info["completed"]:
+            completed.update(range(start, end + 1))
+        return info["id"], completed
+
+    # Written by the sequential scraper, every page up to index is done
+    return info["id"], set(range(FIRST_PAGE, info["index"] + 1))
 
 
-def save_current_scrape_info(id: str, index: int) -> None:
-    with open(CURRENT_SCRAPE_FILE, "w") as f:
-        json.dump({"id": id, "index": index}, f)
+def save_current_scrape_info(id: str, completed: set[int]) -> None:
+    tmp_file = CURRENT_SCRAPE_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"id": id, "completed": to_ranges(completed)}, f)
+    os.replace(tmp_file, CURRENT_SCRAPE_FILE)
+
+
+def fetch_page(
+    client: HttpClient,
+    bucket: TokenBucket,
+    pacer: AdaptivePacer,
+    writer: ArchiveWriter,
+    index: int,
+) -> int:
+    page = client.get_page(URL.format(index=index), pacer, bucket)
+    writer.write_page(index, json.loads(page.body))
+    return index
 
 
 def main():
-    id, index = get_current_scrape_info()
-    print(f"Starting scrape {id} from {index}")
-    os.makedirs(id, exist_ok=True)
-
-    while index < LAST_PAGE:
-        index += 1
-        print(LOGLINE.format(index=index, last_page=LAST_PAGE))
-        url = URL.format(index=index)
-        while True:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configfile", nargs="?")
+    args = parser.parse_args()
+    config = read_config(args.configfile)
+
+    id, completed = get_current_scrape_info()
+    remaining = [
+        index for index in range(FIRST_PAGE, LAST_PAGE + 1) if index not in completed
+    ]
+    print(f"Starting scrape {id}, {len(remaining)} pages left, {config.workers} workers")
+    writer = ArchiveWriter(id)
+    cache = None
+    if config.cache_dir is not None:
+        cache = ResponseCache(config.cache_dir, config.cache_max_megabytes * 1024 * 1024)
+    client = HttpClient(pool_maxsize=config.workers, cache=cache)
+    bucket = TokenBucket(config.requests_per_second)
+    pacer = AdaptivePacer(
+        initial_delay=1 / config.requests_per_second,
+        min_delay=1 / config.requests_per_second,
+        max_delay=MAX_SLEEP_SECONDS,
+        target_latency=config.target_latency,
+        max_retries=config.max_retries,
+    )
+
+    with ThreadPoolExecutor(max_workers=config.workers) as executor:
+        futures = [
+            executor.submit(fetch_page, client, bucket, pacer, writer, index)
+            for index in remaining
+        ]
+        for future in as_completed(futures):
             try:
-                response = requests.get(url, headers=HEADERS)
-                response.raise_for_status()
-                break
-            except requests.RequestException as e:
-                print("error:")
-                print(e)
-                time.sleep(SLEEP_SECONDS)
-        local_filename = FILENAME_TEMPLATE.format(id=id, index=index)
-        with open(local_filename, "w") as f:
-            f.write(json.dumps(response.json(), indent=2))
-        save_current_scrape_info(id, index)
-        time.sleep(SLEEP_SECONDS)
-
-
-main()
+                index = future.result()
+            except Exception:
+                # Out of retries, keep the progress made so far and stop
+                executor.shutdown(cancel_futures=True)
+                raise
+            completed.add(index)
+            save_current_scrape_info(id, completed)
+            print(LOGLINE.format(index=len(completed), last_page=LAST_PAGE + 1))
+
+    print(client.stats())
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
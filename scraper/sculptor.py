@@ -1,208 +1,215 @@
-import sys
+import argparse
 import json
 import os
-import re
 import hashlib
-import csv
-from collections import defaultdict
+import heapq
+import multiprocessing
+import tempfile
+import zlib
+from itertools import groupby
+from typing import Iterator
 from tqdm import tqdm
 
-DATE_KEY = "30"
-STREET_NAME_KEY = "203"
-HOUSE_NUMBER_KEY = "204"
-ADDRESS_KEY = "210"
-DESCRIPTION_KEY = "214"
+from address_parsing import convert_image, normalize
+from artifacts import compact_dump, compact_dumps
+from coord_store import CoordStore
+from raw_archive import read_unit, scrape_units
 
-BLEH = []
+MEMORY_MB = 256
+MAX_RUNS = 64
 
 
-def single_space(address: str) -> str:
-    return " ".join(part for part in address.split(" ") if part != "")
+def href_digest(href: str) -> bytes:
+    return hashlib.blake2b(href.encode(), digest_size=8).digest()
 
 
-def parse_address(address: str) -> set[str]:
+def encode_line(address: str, seq: int, record: str) -> str:
+    # The JSON encoded address never contains a raw tab, and neither does
+    # the record, so tabs are safe separators
+    return f"{json.dumps(address, ensure_ascii=False)}\t{seq}\t{record}\n"
+
+
+def decode_line(line: str) -> tuple[str, int, str]:
+    address, seq, record = line.rstrip("\n").split("\t", 2)
+    return json.loads(address), int(seq), record
+
+
+def read_run(run_path: str) -> Iterator[tuple[str, int, str]]:
+    with open(run_path, encoding="utf-8") as f:
+        for line in f:
+            yield decode_line(line)
+
+
+class ExternalGrouper:
     """
-    Check: what's the usual case for 2A or 2a? Uppercase or lowercase?
-    Edge cases:
-    'Básbryggja 19-21 Naustabryggja 24'
-    'Básbryggja 19-21 Naustabryggja 26'
-    'Dragháls 18-26 18'
-    'Dragháls 18-26 20'
-    'Dragháls 18-26 22'
-    'Dragháls 18-26 24'
-    'Dragháls 18-26 26'
-    'Eirhöfði 8 Breiðhöfði 15'
-    'Gullengi 11*'
-    'Hæðargarður 27 A'
-    'Klapparstígur 1- 7'
-    'Laugavegur 22 -Klapparstígur 33'
-    'Ljósaland 1-25 10'
-    'Ljósaland 1-25 12'
-    'Ljósaland 1-25 14'
-    'Ljósaland 1-25 16'
-    'Ljósaland 1-25 18'
-    'Ljósaland 1-25 2'
-    'Ljósaland 1-25 20'
-    'Ljósaland 1-25 22'
-    'Ljósaland 1-25 24'
-    'Ljósaland 1-25 4'
-    'Ljósaland 1-25 6'
-    'Ljósaland 1-25 8'
-    'Naustabryggja 55- 57'
-    'Skeifan 15, Faxafen 8'
-    'Skrauthólar 5 vegsvæði Vesturlandsvegar'
-    'Skrauthólar 5 vegsvæði hliðarvegar'
-    'Smábýli 12 vegsvæði'
-    'Sundahöfn 1.3, 1.4'
-    'Ártún vegsvæði 2 hliðarvegar'
-    'Ártún vegsvæði 3 hliðarvegar'
-
-    'laugavegur-60a': ['Laugavegur 60A', 'Laugavegur 60a']
-    'eddufell-8': ['Eddufell 8', 'eDDUFELL 8']
-    'eddufell-2': ['Eddufell 2', 'eDDUFELL 2']
-    'eddufell-4': ['Eddufell 4', 'eDDUFELL 4']
-    'eddufell-6': ['Eddufell 6', 'eDDUFELL 6']
-    'skipholt-17a': ['Skipholt 17A', 'Skipholt 17a']
-    'kleppsvegur-bensinstoed': ['Kleppsvegur bensínstöð'
-    'Kleppsvegur Bensínstöð']
-    'vesturgata-5b': ['Vesturgata 5B', 'Vesturgata 5b']
-    'korngardar-13a': ['Korngarðar 13A', 'Korngarðar 13a']
-    'ystibaer-9': ['Ystibær 9', 'ySTIBÆR 9']
-    'laekjargata-14a': ['Lækjargata 14a', 'Lækjargata 14A']
+    Groups (address, seq, record) entries by address without holding them
+    all in memory. Entries are buffered until the buffer grows past
+    `memory_bytes`, then sorted and spilled to a run file. `finish` returns
+    the run files, which `iter_groups` merges back per address.
     """
-    if " - " in address:
-        # "Thorvaldsenstræti 2-6/Aðalstræti 11"
-        addresses = address.split(" - ")
-    elif "/" in address:
-        # "Fossháls 13-15 - Dragháls 14-16"
-        addresses = address.split("/")
-    else:
-        addresses = [address]
-
-    return_addresses = set()
-    for addr in addresses:
-        addr_strip = addr.strip()
-        match = re.match("(?P<street_name>.*) (?P<start>\d+)-(?P<end>\d+)", addr_strip)
-        if match:
-            groupdict = match.groupdict()
-            street_name = groupdict["street_name"]
-            if " " in street_name:
-                BLEH.append(addr_strip)
-            start = int(groupdict["start"])
-            end = int(groupdict["end"])
-            while start <= end:
-                return_addresses.add(single_space(f"{street_name} {start}"))
-                start += 2
-        else:
-            return_addresses.add(single_space(addr_strip))
 
-    return return_addresses
+    def __init__(self, work_dir: str, name: str, memory_bytes: int):
+        self._work_dir = work_dir
+        self._name = name
+        self._memory_bytes = memory_bytes
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._runs = []
+        self._run_count = 0
+
+    def add(self, address: str, seq: int, record: str) -> None:
+        self._buffer.append((address, seq, record))
+        self._buffer_bytes += len(address) + len(record) + 64
+        if self._buffer_bytes > self._memory_bytes:
+            self._spill()
+
+    def _write_run(self, entries: Iterator[tuple[str, int, str]]) -> None:
+        run_path = os.path.join(
+            self._work_dir, f"{self._name}-run-{self._run_count:05d}"
+        )
+        self._run_count += 1
+        with open(run_path, "w", encoding="utf-8") as f:
+            for address, seq, record in entries:
+                f.write(encode_line(address, seq, record))
+        self._runs.append(run_path)
+
+    def _spill(self) -> None:
+        self._buffer.sort()
+        self._write_run(iter(self._buffer))
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        if len(self._runs) >= MAX_RUNS:
+            # Merge the runs into one to keep the number of open files down
+            runs = self._runs
+            self._runs = []
+            self._write_run(heapq.merge(*[read_run(run) for run in runs]))
+            for run_path in runs:
+                os.remove(run_path)
+
+    def finish(self) -> list[str]:
+        if self._buffer:
+            self._spill()
+        return self._runs
+
+
+def iter_groups(runs: list[str]) -> Iterator[tuple[str, int, list[str]]]:
+    """
+    Yield (address, first_seq, records) in address order, with the records
+    of each address in seq order.
+    """
+    merged = heapq.merge(*[read_run(run_path) for run_path in runs])
+    for address, entries in groupby(merged, key=lambda entry: entry[0]):
+        entries = list(entries)
+        yield address, entries[0][1], [record for _, _, record in entries]
+
+
+def convert_unit(args: tuple[str, tuple]) -> list[tuple[bytes, list[str], str]]:
+    """Parse and convert one scrape unit into (href digest, addresses, record)"""
+    scrape_dir, unit = args
+    converted = []
+    for contents in read_unit(scrape_dir, unit):
+        for img in contents["data"]:
+            parsed_addresses, data = convert_image(img)
+            converted.append(
+                (
+                    href_digest(img["href"]),
+                    sorted(parsed_addresses),
+                    compact_dumps(data),
+                )
+            )
+    return converted
+
+
+def write_shard(runs: list[str]) -> list[tuple[int, str, int]]:
+    """Write the address files of one shard, returns (first_seq, address, count)"""
+    written = []
+    for address, first_seq, records in iter_groups(runs):
+        with open(f"addresses/{address}.json", "w", encoding="utf-8") as f:
+            f.write("[" + ",".join(records) + "]")
+        written.append((first_seq, address, len(records)))
+    return written
+
+
+def shard_for(address: str, shards: int) -> int:
+    # crc32 rather than hash() so the sharding doesn't depend on PYTHONHASHSEED
+    return zlib.crc32(address.encode()) % shards
 
 
-def convert_image(img):
-    meta = img["metadata"]
-    if ADDRESS_KEY in meta:
-        address = meta[ADDRESS_KEY]["value"].strip()
-    else:
-        street_name = meta[STREET_NAME_KEY]["value"].strip()
-        house_number = meta[HOUSE_NUMBER_KEY]["value"].strip()
-        address = f"{street_name} {house_number}"
-    parsed_addresses = parse_address(address)
-    if DESCRIPTION_KEY in meta:
-        description = meta[DESCRIPTION_KEY]["value"].strip()
-    else:
-        description = "[Lýsingu vantar]"
-
-    date = meta[DATE_KEY]["value"].strip() if DATE_KEY in meta else None
-    hash = hashlib.md5(img["href"].encode()).hexdigest()[:7]
-
-    data = {
-        "address": address,
-        "date": date,
-        "description": description,
-        "hash": hash,
-        "images": {preview["size"]: preview for preview in img["previews"]},
-        "originalHref": img["href"],
-    }
-    return parsed_addresses, data
-
-
-def normalize(address):
-    return (
-        address.lower()
-        .replace("á", "a")
-        .replace("é", "e")
-        .replace("í", "i")
-        .replace("ó", "o")
-        .replace("ú", "u")
-        .replace("ý", "y")
-        .replace("þ", "t")
-        .replace("æ", "ae")
-        .replace("ö", "o")
-        .replace("ð", "d")
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scrape_dir")
+    parser.add_argument(
+        "--memory-mb",
+        type=int,
+        default=MEMORY_MB,
+        help="Records buffered in memory before spilling to disk",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Worker processes for converting pages and writing address files",
+    )
+    args = parser.parse_args()
 
-
-def main():
-    if len(sys.argv) != 2:
-        print("Error: missing scrape dir", file=sys.stderr)
-        return
-
-    scrape_dir = sys.argv[1]
-    image_files = os.listdir(scrape_dir)
-    print(len(image_files))
-    imgs = []
-    hrefs = set()
-    for filename in tqdm(image_files):
-        full_path = os.path.join(scrape_dir, filename)
-        with open(full_path) as f:
-            contents = json.load(f)
-            for img in contents["data"]:
-                if img["href"] not in hrefs:
-                    hrefs.add(img["href"])
-                    imgs.append(img)
-
-    print(len(imgs))
-
-    addresses = defaultdict(list)
-    for img in imgs:
-        parsed_addresses, data = convert_image(img)
-        for addr in parsed_addresses:
-            addresses[addr].append(data)
-
-    coords = {}
-    with open("Stadfangaskra.csv") as f:
-        stadfangaskra = csv.DictReader(f)
-        for row in stadfangaskra:
-            if int(row["POSTNR"]) < 200:
-                address = f"{row['HEITI_NF']} {row['HUSNR']}"
-                lat = float(row["N_HNIT_WGS84"])
-                lng = float(row["E_HNIT_WGS84"])
-                coords[address] = [lat, lng]
-
-    if True:
-        os.makedirs("addresses", exist_ok=True)
-        for address, drawings in tqdm(addresses.items()):
-            with open(f"addresses/{address}.json", "w") as f:
-                json.dump(drawings, f, ensure_ascii=False)
-
-        address_index = []
-        with open("addresses.json", "w") as f:
-            for address, drawings in addresses.items():
-                address_info = {
-                    "address": address,
-                    "normalized": normalize(address),
-                    "count": len(drawings),
-                }
-                if address in coords:
-                    address_info["coords"] = coords[address]
-
-                address_index.append(address_info)
-            json.dump(address_index, f, ensure_ascii=False)
+    units = scrape_units(args.scrape_dir)
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    convert_args = [(args.scrape_dir, unit) for unit in units]
+    if pool is not None:
+        converted_units = pool.imap(convert_unit, convert_args)
     else:
-        import IPython
-
-        IPython.embed()
-
+        converted_units = map(convert_unit, convert_args)
 
-main()
+    # Hrefs are deduplicated on 8 byte digests instead of the full strings
+    hrefs = set()
+    img_count = 0
+    seq = 0
+    os.makedirs("addresses", exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=".") as work_dir:
+        memory_bytes = args.memory_mb * 1024 * 1024 // args.jobs
+        groupers = [
+            ExternalGrouper(work_dir, f"shard-{shard}", memory_bytes)
+            for shard in range(args.jobs)
+        ]
+        for converted in tqdm(converted_units, total=len(units)):
+            for digest, parsed_addresses, record in converted:
+                if digest in hrefs:
+                    continue
+                hrefs.add(digest)
+                img_count += 1
+                for addr in parsed_addresses:
+                    groupers[shard_for(addr, args.jobs)].add(addr, seq, record)
+                    seq += 1
+
+        print(img_count)
+
+        shard_runs = [grouper.finish() for grouper in groupers]
+        if pool is not None:
+            written = pool.map(write_shard, shard_runs)
+            pool.close()
+            pool.join()
+        else:
+            written = [write_shard(runs) for runs in shard_runs]
+
+    coords = CoordStore("Stadfangaskra.csv")
+    address_index = []
+    # Same order as the addresses were first seen in the archive
+    for _, address, count in sorted(entry for shard in written for entry in shard):
+        address_info = {
+            "address": address,
+            "normalized": normalize(address),
+            "count": count,
+        }
+        address_coords = coords.get(address)
+        if address_coords is not None:
+            address_info["coords"] = address_coords
+        address_index.append(address_info)
+    coords.close()
+
+    with open("addresses.json", "w", encoding="utf-8") as f:
+        compact_dump(address_index, f)
+
+
+if __name__ == "__main__":
+    main()
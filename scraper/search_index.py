@@ -0,0 +1,56 @@
+"""
+Address search index split into shards by the first characters of the
+normalized address.
+
+Every address is in the shard for its first character, unless that shard
+would hold more than SHARD_MAX_ENTRIES addresses, in which case it is split
+by the first two characters. The shard manifest maps each prefix to the
+file holding it, and the client picks the longest prefix of its query that
+is in the manifest. Shard files are named by the hash of their content, so
+an unchanged shard keeps its name and does not need to be uploaded again.
+"""
+
+import hashlib
+import os
+from collections import defaultdict
+
+from artifacts import compact_dumps
+
+SHARD_MAX_ENTRIES = 500
+MANIFEST_FILENAME = "search-manifest.json"
+
+
+def build_shards(address_index: list[dict]) -> dict[str, list[dict]]:
+    by_first = defaultdict(list)
+    for address_info in address_index:
+        by_first[address_info["normalized"][:1]].append(address_info)
+
+    shards = {}
+    for prefix, entries in by_first.items():
+        if len(entries) <= SHARD_MAX_ENTRIES:
+            shards[prefix] = entries
+            continue
+        for address_info in entries:
+            shards.setdefault(address_info["normalized"][:2], []).append(address_info)
+
+    return {
+        prefix: sorted(entries, key=lambda address_info: address_info["normalized"])
+        for prefix, entries in sorted(shards.items())
+    }
+
+
+def write_shards(search_dir: str, address_index: list[dict]) -> dict:
+    """Write the shard files to `search_dir` and return the shard manifest"""
+    os.makedirs(search_dir, exist_ok=True)
+    manifest = {"shards": {}}
+    for prefix, entries in build_shards(address_index).items():
+        content = compact_dumps(entries).encode()
+        filename = hashlib.md5(content).hexdigest() + ".json"
+        with open(os.path.join(search_dir, filename), "wb") as f:
+            f.write(content)
+        manifest["shards"][prefix] = {"file": filename, "count": len(entries)}
+    return manifest
+
+
+def shard_files(manifest: dict) -> set[str]:
+    return set(shard["file"] for shard in manifest["shards"].values())
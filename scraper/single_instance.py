@@ -0,0 +1,42 @@
+"""
+Lockfiles that keep two copies of a job from running at once, for example
+when cron starts a scrape while the previous one is still going, or while
+daemon.py is running the same job.
+"""
+
+import fcntl
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class AlreadyRunning(Exception):
+    pass
+
+
+@contextmanager
+def single_instance(lockfile: str) -> Iterator[None]:
+    """
+    Hold an exclusive lock on `lockfile` for the duration of the block.
+    Raises AlreadyRunning straight away when another process holds it. The
+    lock goes away with the process, so a crash never leaves a stale lock.
+    """
+    os.makedirs(os.path.dirname(lockfile) or ".", exist_ok=True)
+    f = open(lockfile, "a+")
+    try:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.seek(0)
+            pid = f.read().strip() or "unknown"
+            raise AlreadyRunning(f"{lockfile} is held by pid {pid}")
+        f.truncate(0)
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        try:
+            yield
+        finally:
+            f.truncate(0)
+            fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        f.close()
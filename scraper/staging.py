@@ -0,0 +1,158 @@
+import json
+import sqlite3
+from itertools import groupby
+from typing import Iterable, Iterator
+
+from artifacts import compact_dumps
+
+
+class StagingStore:
+    """
+    Append-only store for the records of a single scrape.
+
+    Records are only ever inserted while the scrape runs. Grouping them into
+    per-address files happens once, in bulk, through `iter_addresses`.
+
+    The store doubles as the scrape's checkpoint journal: a page's records,
+    its hrefs and the status to resume from are committed in one
+    transaction. Commits go to the write-ahead log without an fsync, `sync`
+    makes everything committed so far durable and is called every few pages.
+    A crash loses at most the pages since the last sync, and never leaves
+    records without the status that accounts for them.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                address TEXT NOT NULL,
+                data TEXT NOT NULL
+            )
+            """
+        )
+        # `cursor` is the listing cursor that staged the href, NULL in stores
+        # from before the cursors ran side by side
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hrefs (href TEXT PRIMARY KEY, cursor TEXT)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(hrefs)")]
+        if "cursor" not in columns:
+            self._conn.execute("ALTER TABLE hrefs ADD COLUMN cursor TEXT")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                status TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def append_many(
+        self,
+        rows: list[tuple[str, dict]],
+        hrefs: Iterable[str] = (),
+        checkpoint: dict | None = None,
+        cursor: str | None = None,
+    ) -> None:
+        """
+        Append records, mark their hrefs as seen by `cursor` and record the
+        checkpoint status, if given, in one transaction
+        """
+        with self._conn:
+            if checkpoint is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO checkpoint (id, status) VALUES (1, ?)",
+                    (compact_dumps(checkpoint),),
+                )
+            self._conn.executemany(
+                "INSERT INTO records (address, data) VALUES (?, ?)",
+                [(address, compact_dumps(img_data)) for address, img_data in rows],
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO hrefs (href, cursor) VALUES (?, ?)",
+                [(href, cursor) for href in hrefs],
+            )
+
+    def cursors_of(self, hrefs: list[str]) -> set[str | None]:
+        """The cursors that staged any of `hrefs`"""
+        placeholders = ",".join("?" * len(hrefs))
+        cursor = self._conn.execute(
+            f"SELECT DISTINCT cursor FROM hrefs WHERE href IN ({placeholders})",
+            hrefs,
+        )
+        return set(row[0] for row in cursor)
+
+    def read_checkpoint(self) -> dict | None:
+        row = self._conn.execute("SELECT status FROM checkpoint").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def sync(self) -> None:
+        """Make every committed transaction durable"""
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def has_href(self, href: str) -> bool:
+        cursor = self._conn.execute("SELECT 1 FROM hrefs WHERE href = ?", (href,))
+        return cursor.fetchone() is not None
+
+    def iter_hrefs(self) -> Iterator[str]:
+        for (href,) in self._conn.execute("SELECT href FROM hrefs"):
+            yield href
+
+    def iter_addresses(self) -> Iterator[tuple[str, list[str]]]:
+        """
+        Yield (address, records) in address order, where records are the
+        JSON encoded records in the order they were appended.
+        """
+        # Building the index once here is cheaper than keeping it up to date
+        # on every insert during the scrape
+        with self._conn:
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS records_address ON records (address, id)"
+            )
+        cursor = self._conn.execute(
+            "SELECT address, data FROM records ORDER BY address, id"
+        )
+        for address, rows in groupby(cursor, key=lambda row: row[0]):
+            yield address, [data for _, data in rows]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class HrefCatalog:
+    """
+    Every href seen by previous scrapes, persisted across scrapes so an
+    incremental scrape can tell new drawings from known ones.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS hrefs (href TEXT PRIMARY KEY)")
+        self._conn.commit()
+
+    def __contains__(self, href: str) -> bool:
+        cursor = self._conn.execute("SELECT 1 FROM hrefs WHERE href = ?", (href,))
+        return cursor.fetchone() is not None
+
+    def add_many(self, hrefs: Iterable[str]) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO hrefs (href) VALUES (?)",
+                ((href,) for href in hrefs),
+            )
+
+    def replace(self, hrefs: Iterable[str]) -> None:
+        with self._conn:
+            self._conn.execute("DELETE FROM hrefs")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO hrefs (href) VALUES (?)",
+                ((href,) for href in hrefs),
+            )
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,63 @@
+"""
+Addresses with coordinates grouped into slippy map tiles at TILE_ZOOM, so a
+map can load only the tiles in its viewport.
+
+The tile manifest maps "z/x/y" to the file holding the addresses in that
+tile. As with the search shards, tile files are named by the hash of their
+content and an unchanged tile does not need to be uploaded again.
+"""
+
+import hashlib
+import math
+import os
+from collections import defaultdict
+
+from artifacts import compact_dumps
+
+# Tiles are roughly 1 km across at Reykjavík's latitude
+TILE_ZOOM = 14
+MANIFEST_FILENAME = "tile-manifest.json"
+
+
+def tile_for(lat: float, lng: float, zoom: int = TILE_ZOOM) -> tuple[int, int]:
+    n = 2**zoom
+    x = int((lng + 180) / 360 * n)
+    lat_rad = math.radians(lat)
+    y = int((1 - math.asinh(math.tan(lat_rad)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def build_tiles(address_index: list[dict]) -> dict[str, list[dict]]:
+    tiles = defaultdict(list)
+    for address_info in address_index:
+        if "coords" not in address_info:
+            continue
+        x, y = tile_for(*address_info["coords"])
+        tiles[f"{TILE_ZOOM}/{x}/{y}"].append(
+            {
+                "address": address_info["address"],
+                "count": address_info["count"],
+                "coords": address_info["coords"],
+            }
+        )
+    return {
+        tile: sorted(entries, key=lambda entry: entry["address"])
+        for tile, entries in sorted(tiles.items())
+    }
+
+
+def write_tiles(tile_dir: str, address_index: list[dict]) -> dict:
+    """Write the tile files to `tile_dir` and return the tile manifest"""
+    os.makedirs(tile_dir, exist_ok=True)
+    manifest = {"zoom": TILE_ZOOM, "tiles": {}}
+    for tile, entries in build_tiles(address_index).items():
+        content = compact_dumps(entries).encode()
+        filename = hashlib.md5(content).hexdigest() + ".json"
+        with open(os.path.join(tile_dir, filename), "wb") as f:
+            f.write(content)
+        manifest["tiles"][tile] = {"file": filename, "count": len(entries)}
+    return manifest
+
+
+def tile_files(manifest: dict) -> set[str]:
+    return set(tile["file"] for tile in manifest["tiles"].values())